@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Benchmarks of the King & Assassins game server
+
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+
+import kingandassassins as ka
+
+# Recorded results the suite is compared with, and the slowdown (in percent)
+# of a benchmark above which it is reported as a regression
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-baseline.json')
+THRESHOLD = 25
+
+
+def midgame(seed, turns=10):
+    '''Build a server whose game has been played for some turns.
+
+    Pre: -
+    Post: The returned server holds a game in which 'turns' turns of random
+          legal actions have been played from the seeded initial state.
+    '''
+    rnd = random.Random(seed)
+    server = ka.KingAndAssassinsServer()
+    server._state = state = ka._newstate(rnd)
+    state.setassassins(rnd.sample(sorted(ka.POPULATION), 3))
+    state.update([], 0)
+    player = 1
+    for turn in range(turns):
+        actions = []
+        legal = state.legal_actions(player)
+        while len(legal) > 0 and len(actions) < 4:
+            action = rnd.choice(legal)
+            state.apply(action, player)
+            actions.append(action)
+            legal = state.legal_actions(player)
+        state.apply(ka.END, player)
+        state.lastopponentmove = actions
+        player = 1 - player
+    return server
+
+
+def server_turn(seed=0, number=2000):
+    '''Measure the per-turn overhead of the server, in microseconds.
+
+    The 'deepcopy' benchmark is how each PLAY message used to be built (a deep
+    copy of the state then its serialisation), the other ones are the ways a
+    turn's message is now built, and the cost of a move once received.
+    '''
+    server = midgame(seed)
+    state = server._state
+    move = json.dumps({'actions': state.legal_actions(1)[:1]})
+    benchmarks = {
+        'PLAY (deepcopy)': lambda: 'PLAY {}'.format(copy.deepcopy(state)).encode(),
+        'PLAY (live state)': lambda: 'PLAY {}'.format(state).encode(),
+        'PACKED': lambda: b'PACKED ' + state.pack(),
+        'DELTA': lambda: 'DELTA {}'.format(state.delta()).encode(),
+        'move + winner': lambda: _applyandundo(state, move)
+    }
+    return _measure(benchmarks, number)
+
+
+def situations(seed=0):
+    '''Find, for each type of action, a state in which it can be played.
+
+    Pre: -
+    Post: The returned value maps each type of action (see ka.ACTIONS) to a
+          triple (state, player, action) such that 'action' of this type is
+          legal for 'player' at the beginning of its turn in 'state'. The
+          states come from seeded games of random legal actions.
+    '''
+    found = {}
+    game = 0
+    while len(found) < len(ka.ACTIONS):
+        rnd = random.Random(seed * 1000 + game)
+        state = ka._newstate(rnd)
+        state.setassassins(rnd.sample(sorted(ka.POPULATION), 3))
+        state.update([], 0)
+        player = 1
+        while state.winner() == -1:
+            legal = state.legal_actions(player)
+            for action in legal:
+                if action[0] not in found:
+                    found[action[0]] = (state.copy(), player, action)
+            if len(legal) > 0 and rnd.random() < 0.8:
+                state.apply(rnd.choice(legal), player)
+            else:
+                state.apply(ka.END, player)
+                player = 1 - player
+        game += 1
+    return found
+
+
+def engine(seed=0, number=2000):
+    '''Measure the hot paths of the game engine, in microseconds.
+
+    The update benchmarks play a one-action move (on a copy of the state,
+    whose cost is the 'copy' benchmark) for each type of action.
+    '''
+    server = midgame(seed)
+    state = server._state
+    text = str(state)
+    benchmarks = {
+        'copy': lambda: state.copy()
+    }
+    for name, (situation, player, action) in sorted(situations(seed).items()):
+        benchmarks['update ({})'.format(name)] = (
+            lambda situation=situation, player=player, action=action: situation.copy().update([action], player))
+    benchmarks.update({
+        'winner': lambda: state.winner(),
+        '_getcoord': lambda: state._getcoord((4, 5, 'N')),
+        'parse + str': lambda: str(ka.KingAndAssassinsState.parse(text)),
+        'GameServer.state': lambda: server.state
+    })
+    return _measure(benchmarks, number)
+
+
+def bots(seed=0, number=20, thinkms=20):
+    '''Measure the latency of the moves of each bot, in microseconds.
+
+    Each run builds a new bot (not measured), lets it choose its assassins if
+    it plays first, then measures its _nextmove on a seeded game state; the
+    result is the median of the runs. In player 0's state, the assassins the
+    bot chose are already revealed, so that it plans a whole turn instead of
+    revealing one of them. The search-based bots think for 'thinkms'
+    milliseconds.
+    '''
+    results = {}
+    for bot in sorted(ka.BOTS):
+        for player in range(2):
+            # midgame() plays an even number of turns from player 1's one
+            state = midgame(seed, turns=10 + (1 - player))._state.copy(hidden=False)
+            initial = ka._newstate(random.Random(seed))
+            durations = []
+            for i in range(number):
+                client = ka.BOTS[bot]('benchmark', None, **ka._botoptions(bot, thinkms))
+                client.seed(seed + i)
+                client._playernb = player
+                situation = state
+                if player == 0:
+                    situation = _revealed(state, json.loads(client._nextmove(initial))['assassins'])
+                start = time.perf_counter()
+                client._nextmove(situation)
+                durations.append(time.perf_counter() - start)
+            results['{} _nextmove (player {})'.format(bot, player)] = statistics.median(durations) * 1e6
+    return results
+
+
+def _measure(benchmarks, number, repeat=5):
+    # Best of 'repeat' runs of 'number' calls, in microseconds per call
+    return {
+        name: min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+        for name, function in benchmarks.items()
+    }
+
+
+def suite(seed=0, number=2000, thinkms=20):
+    '''Run all the benchmarks.
+
+    Pre: -
+    Post: The returned value maps the name of each benchmark to its duration
+          in microseconds.
+    '''
+    results = {}
+    results.update(server_turn(seed, number))
+    results.update(engine(seed, number))
+    results.update(bots(seed, max(5, number // 100), thinkms))
+    return results
+
+
+def regressions(results, baseline, threshold=THRESHOLD):
+    '''Compare results with a baseline.
+
+    Pre: 'results' and 'baseline' map names of benchmarks to durations.
+    Post: The returned value maps the name of each benchmark that is more
+          than 'threshold' percent slower than in the baseline to its
+          slowdown, in percent. Benchmarks missing from either are ignored.
+    '''
+    slowdowns = {}
+    for name, duration in results.items():
+        if name in baseline and baseline[name] > 0:
+            slowdown = (duration / baseline[name] - 1) * 100
+            if slowdown > threshold:
+                slowdowns[name] = slowdown
+    return slowdowns
+
+
+def _revealed(state, assassins):
+    # Copy of a state in which the villagers 'assassins' have been revealed
+    state = state.copy()
+    for cell in sorted(state.villagers):
+        if ka.PIECES[state.cells[cell]] in assassins:
+            state._setcell(cell, ka.ASSASSIN)
+    return state
+
+
+def _applyandundo(state, move):
+    # What the server does with a received move (decoding, update and
+    # winner), undone afterwards
+    records = [state.apply(action, 1) for action in json.loads(move)['actions']]
+    records.append(state.apply(ka.END, 1))
+    state.winner()
+    for record in reversed(records):
+        state.undo(record)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins benchmarks')
+    parser.add_argument('--seed', help='seed of the benchmarked game (default: 0)', type=int, default=0)
+    parser.add_argument('--number', help='number of runs of each benchmark (default: 2000)', type=int, default=2000)
+    parser.add_argument('--think-ms', help='thinking time of the search-based bots (default: 20)', type=int,
+                        default=20)
+    parser.add_argument('--baseline', help='file of the recorded results (default: {})'.format(
+        os.path.basename(BASELINE)), default=BASELINE)
+    parser.add_argument('--record', help='record the results as the new baseline', action='store_true')
+    parser.add_argument('--threshold', help='slowdown reported as a regression, in percent (default: {})'.format(
+        THRESHOLD), type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    settings = {'seed': args.seed, 'number': args.number, 'thinkms': args.think_ms}
+    results = suite(args.seed, args.number, args.think_ms)
+    baseline = {}
+    if not args.record and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            recorded = json.load(file)
+        if recorded['settings'] != settings:
+            print('The baseline was recorded with other settings: {}'.format(recorded['settings']))
+        baseline = recorded['results']
+    slowdowns = regressions(results, baseline, args.threshold)
+
+    for name, duration in results.items():
+        line = ' - {:<32} {:>11.1f} us'.format(name, duration)
+        if name in baseline:
+            line += '  {:>+7.1f} %'.format((duration / baseline[name] - 1) * 100)
+        if name in slowdowns:
+            line += '  REGRESSION'
+        print(line)
+
+    if args.record:
+        with open(args.baseline, 'w') as file:
+            json.dump({
+                'settings': settings,
+                'python': platform.python_version(),
+                'results': {name: round(duration, 3) for name, duration in results.items()}
+            }, file, indent=2)
+            file.write('\n')
+        print('Baseline recorded in {}'.format(args.baseline))
+    elif len(slowdowns) > 0:
+        print('{} benchmark(s) more than {:g} % slower than the baseline'.format(len(slowdowns), args.threshold))
+        sys.exit(1)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# kabatch.py
+# Batch engine of the King & Assassins game, stepping many games at once with NumPy
+
+import argparse
+import random
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import kingandassassins as ka
+from lib import game
+
+# Actions are numbered: action kind*4+d (kind being a move, an arrest, a kill
+# or an attack) of the piece on a cell is cell*17 + kind*4 + d, its reveal is
+# cell*17 + 16, and END is the last one
+KINDS = 17
+END = 100 * KINDS
+NBACTIONS = END + 1
+REVEAL = ka.ACTIONS.index('reveal')
+ENDKIND = len(ka.ACTIONS)
+
+
+def encode(action):
+    '''Get the number of an action, as given by legal_actions or END.'''
+    if action[0] == 'end':
+        return END
+    kind = ka.ACTIONS.index(action[0])
+    cell = int(action[1]) * 10 + int(action[2])
+    if kind == REVEAL:
+        return cell * KINDS + KINDS - 1
+    return cell * KINDS + kind * 4 + ka.DIRS.index(action[3])
+
+
+def decode(number):
+    '''Get the action whose number is 'number' (see encode).'''
+    number = int(number)
+    if number == END:
+        return ka.END
+    x, y = divmod(number // KINDS, 10)
+    kind, d = divmod(number % KINDS, 4)
+    if kind == REVEAL:
+        return ('reveal', x, y)
+    return (ka.ACTIONS[kind], x, y, ka.DIRS[d])
+
+
+def newgame(seed):
+    '''Build the state of a new game from a seed, its assassins chosen.
+
+    Pre: -
+    Post: The returned state is kingandassassins.newgame(seed) in which the
+          assassins, drawn from the same seed, have been chosen and the first
+          card has been drawn: player 1 plays first.
+    '''
+    state = ka.newgame(seed)
+    ka._applymove(state, {'assassins': random.Random(seed).sample(sorted(ka.POPULATION), ka.NBASSASSINS)}, 0)
+    return state
+
+
+if np is not None:
+    # Static tables: the next cell in each direction (-1 off the board), the
+    # ground cells, the door steps entering the castle and the castle cells
+    STEPS = np.array([ka.TOPOLOGY.steps[d] for d in ka.DIRS], dtype=np.int16)
+    GROUND = np.array(ka.TOPOLOGY.ground, dtype=bool)
+    ENTRIES = np.zeros((100, len(ka.DIRS)), dtype=bool)
+    for door, d in ka.TOPOLOGY.entries:
+        ENTRIES[door, ka.DIRS.index(d)] = True
+    CASTLE = np.array(sorted(ka.TOPOLOGY.castle), dtype=np.int16)
+    # Action points of the king, the knights and the people for each card
+    CARDAP = np.array([(card[0], card[1], card[3]) for card in ka.CARDS], dtype=np.int8)
+    POPCOUNT = np.array([bin(mask).count('1') for mask in range(1 << len(ka.POPULATION))], dtype=np.int8)
+    # Next cell of every cell in each direction, 100 off the board (the
+    # extra column of the cells, see _actionkinds), and whether the king may
+    # step there: onto the ground, or into the castle through a door
+    TARGETS = np.where(STEPS.T >= 0, STEPS.T, 100)
+    KINGSTEPS = np.append(GROUND, False)[TARGETS] | ENTRIES
+    # The cell of every cell and direction, and its target shifted by 101
+    # when the king may step there (see _actionkinds)
+    SOURCES = np.repeat(np.arange(100), len(ka.DIRS)).reshape(100, len(ka.DIRS))
+    KINGTARGETS = TARGETS + KINGSTEPS * 101
+    # Kind, cell and direction of every numbered action
+    ACTIONKINDS = np.array([number % KINDS // 4 for number in range(END)] + [ENDKIND], dtype=np.int16)
+    ACTIONCELLS = np.array([number // KINDS for number in range(END)] + [0], dtype=np.int16)
+    ACTIONDIRS = np.array([number % KINDS % 4 for number in range(END)] + [0], dtype=np.int16)
+
+
+class BatchState:
+    '''Class representing a batch of King & Assassins games.
+
+    The B games are held in arrays: the piece codes of the cells (B x 100,
+    see board for the B x 10 x 10 view), the king's health, the killed
+    knights and assassins, the current card (index in CARDS), the action
+    points left, the masks of the arrested villagers and of the assassins,
+    the deck of each game (its first 'ncards' cards are left, the last of
+    them being the next one drawn) and the player to play.
+
+    step() applies one numbered action (see encode) in every game, with the
+    rules of KingAndAssassinsState.apply, which stays the reference (see
+    crosscheck): an invalid action leaves its game unchanged, END finishes
+    the turn, drawing a new card after player 0's one.
+    '''
+    def __init__(self, size):
+        if np is None:
+            raise ImportError('the batch engine needs NumPy')
+        self.size = size
+        self.cells = np.zeros((size, 100), dtype=np.uint8)
+        self.king = np.zeros(size, dtype=np.int8)
+        self.killedknights = np.zeros(size, dtype=np.int8)
+        self.killedassassins = np.zeros(size, dtype=np.int8)
+        self.card = np.zeros(size, dtype=np.int16)
+        self.kingap = np.zeros(size, dtype=np.int8)
+        self.knightsap = np.zeros(size, dtype=np.int8)
+        self.peopleap = np.zeros(size, dtype=np.int8)
+        self.arrested = np.zeros(size, dtype=np.int16)
+        self.assassins = np.zeros(size, dtype=np.int16)
+        self.deck = np.zeros((size, len(ka.CARDS)), dtype=np.int16)
+        self.ncards = np.zeros(size, dtype=np.int16)
+        self.player = np.zeros(size, dtype=np.int8)
+
+    @classmethod
+    def fromstates(cls, states, players):
+        '''Build a batch from scalar states.
+
+        Pre: 'states' are KingAndAssassinsState with their hidden part, in
+             which the assassins have been chosen, and players[i] is the
+             player to play in states[i], at the beginning of its turn or
+             during it.
+        Post: The returned batch holds copies of the states.
+        '''
+        batch = cls(len(states))
+        for i, state in enumerate(states):
+            batch.cells[i] = np.frombuffer(bytes(state.cells), dtype=np.uint8)
+            batch.king[i] = state.king
+            batch.killedknights[i] = state.killedknights
+            batch.killedassassins[i] = state.killedassassins
+            batch.card[i] = state.card
+            batch.kingap[i], batch.knightsap[i], batch.peopleap[i] = state.kingap, state.knightsap, state.peopleap
+            batch.arrested[i] = state.arrested
+            batch.assassins[i] = state.assassins
+            batch.deck[i, :len(state.cards)] = state.cards
+            batch.ncards[i] = len(state.cards)
+            batch.player[i] = players[i]
+        return batch
+
+    @classmethod
+    def newgames(cls, seeds):
+        '''Build a batch of new games, one for each seed.
+
+        Pre: -
+        Post: Game i is newgame(seeds[i]): player 1 plays.
+        '''
+        return cls.fromstates([newgame(seed) for seed in seeds], [1] * len(seeds))
+
+    @property
+    def board(self):
+        return self.cells.reshape(self.size, 10, 10)
+
+    def tostate(self, i):
+        '''Get game i as a scalar KingAndAssassinsState, hidden part included.'''
+        state = ka.KingAndAssassinsState.__new__(ka.KingAndAssassinsState)
+        state.cells = bytearray(self.cells[i].tobytes())
+        state.card = int(self.card[i])
+        state.king = int(self.king[i])
+        state.killedknights = int(self.killedknights[i])
+        state.killedassassins = int(self.killedassassins[i])
+        state.arrested = int(self.arrested[i])
+        state.lastopponentmove = []
+        state.assassins = int(self.assassins[i])
+        state.cards = [int(card) for card in self.deck[i, :self.ncards[i]]]
+        state._index()
+        state.kingap = int(self.kingap[i])
+        state.knightsap = int(self.knightsap[i])
+        state.peopleap = int(self.peopleap[i])
+        return state
+
+    def winner(self):
+        '''Get the winner of every game, as KingAndAssassinsState.winner (-1 while it is going on).'''
+        winner = np.full(self.size, -1, dtype=np.int8)
+        # From the weakest condition to the strongest one
+        caught = self.killedassassins + POPCOUNT[self.arrested & self.assassins]
+        winner[caught == ka.NBASSASSINS] = 1
+        winner[self.king == ka.DEAD] = 0
+        winner[self.ncards == 0] = 0
+        winner[(self.cells[:, CASTLE] == ka.KING).any(axis=1)] = 1
+        return winner
+
+    def legalmask(self):
+        '''Get the valid actions of every game.
+
+        Pre: -
+        Post: The returned value is a B x NBACTIONS array of booleans telling
+              whether each numbered action is valid for the player to play in
+              each game, as legal_actions and END. Nothing is valid in a
+              finished game.
+        '''
+        games = np.nonzero(self.winner() == -1)[0]
+        kinds, reveals = self._actionkinds(games)
+        mask = np.zeros((self.size, NBACTIONS), dtype=bool)
+        actions = np.zeros((len(games), 100, KINDS), dtype=bool)
+        for kind in range(REVEAL):
+            actions[:, :, kind * 4:kind * 4 + 4] = kinds == kind
+        actions[:, :, KINDS - 1] = reveals
+        mask[games, :END] = actions.reshape(len(games), END)
+        mask[games, END] = True
+        return mask
+
+    def step(self, actions):
+        '''Apply one action in every game.
+
+        Pre: 'actions' holds B numbered actions (see encode).
+        Post: actions[i] has been applied for the player to play in game i if
+              it was valid there, and the returned value is the B booleans
+              telling which ones were. Finished games are left unchanged.
+        '''
+        actions = np.asarray(actions)
+        kinds, cells, dirs = ACTIONKINDS[actions], ACTIONCELLS[actions], ACTIONDIRS[actions]
+        games = np.arange(self.size)
+        pieces = self.cells[games, cells].astype(np.int16)
+        targets = TARGETS[cells, dirs]
+        onboard = targets < 100
+        targets = np.where(onboard, self.cells[games, np.where(onboard, targets, 0)].astype(np.int16), -1)
+        valid = _kinds(pieces, targets, KINGSTEPS[cells, dirs], self.player, self.kingap, self.knightsap,
+                       self.peopleap) == kinds
+        valid |= (kinds == REVEAL) & _reveals(pieces, self.player, self.assassins)
+        valid |= kinds == ENDKIND
+        valid &= self.winner() == -1
+        games = np.nonzero(valid)[0]
+        self._play(games, kinds[games], cells[games], dirs[games])
+        return valid
+
+    def playout(self, rng, maxsteps=100000):
+        '''Play every game to its end with random valid actions.
+
+        Pre: 'rng' is a numpy.random.Generator.
+        Post: The returned value is the winner of every game, after at most
+              'maxsteps' steps (-1 for the games still going on).
+        '''
+        for i in range(maxsteps):
+            games = np.nonzero(self.winner() == -1)[0]
+            if len(games) == 0:
+                break
+            # A valid action drawn uniformly in each game: first a cell, with
+            # the number of its valid actions (its directional ones and its
+            # reveal) as weight, END being an extra cell, then one of them
+            kinds, reveals = self._actionkinds(games)
+            valid = kinds >= 0
+            options = np.ones((len(games), 101), dtype=np.int16)
+            options[:, :100] = reveals
+            for d in range(len(ka.DIRS)):
+                options[:, :100] += valid[:, :, d]
+            cumulated = np.cumsum(options, axis=1)
+            draws = (rng.random(len(games)) * cumulated[:, -1]).astype(np.int16)
+            cells = np.argmax(cumulated > draws[:, None], axis=1)
+            rows = np.arange(len(games))
+            ranks = draws - cumulated[rows, cells] + options[rows, cells]
+            end = cells == 100
+            cells[end] = 0
+            choices = np.concatenate((valid[rows, cells], reveals[rows, cells, None]), axis=1)
+            chosen = np.argmax(np.cumsum(choices, axis=1) > ranks[:, None], axis=1)
+            dirs = np.where(chosen < len(ka.DIRS), chosen, 0)
+            actionkinds = np.where(chosen < len(ka.DIRS), kinds[rows, cells, dirs], REVEAL)
+            self._play(games, np.where(end, ENDKIND, actionkinds), cells, dirs)
+        return self.winner()
+
+    def _actionkinds(self, games):
+        # Valid actions of some running games (G of them): the kind (-1 if
+        # none, see _kinds) of the one of the piece on each cell in each
+        # direction, G x 100 x 4, looked up in KINDTABLE, and whether its
+        # reveal is valid, G x 100
+        cells = np.empty((len(games), 101), dtype=np.uint8)
+        cells[:, :100] = self.cells[games]
+        cells[:, 100] = OFFBOARD
+        classes = CLASSES[cells]
+        player = self.player[games]
+        context = (player * 8 + (self.kingap[games] > 0) * 4 + (self.knightsap[games] > 0) * 2
+                   + (self.peopleap[games] > 0))
+        # Parts of the indices in KINDTABLE given by the piece and by its
+        # target and the king's step, gathered for each cell and direction
+        pieces = (context[:, None].astype(np.int16) * len(CLASSCODES) + classes[:, :100]) * (len(CLASSCODES) * 2)
+        targets = np.concatenate((classes * 2, classes * 2 + 1), axis=1)
+        kinds = KINDTABLE.take(pieces[:, SOURCES] + targets[:, KINGTARGETS])
+        reveals = _reveals(cells[:, :100].astype(np.int16), player[:, None], self.assassins[games, None])
+        return kinds, reveals
+
+    def _play(self, games, kinds, cells, dirs):
+        # Apply valid actions, action i in game games[i]
+        board = self.cells
+        targets = STEPS[dirs, cells]
+        pieces = board[games, cells]
+        # Moves
+        m = kinds == 0
+        g, src, dst, piece = games[m], cells[m], targets[m], pieces[m]
+        board[g, dst] = piece
+        board[g, src] = ka.EMPTY
+        self.kingap[g[piece == ka.KING]] -= 1
+        self.knightsap[g[piece == ka.KNIGHT]] -= 1
+        self.peopleap[g[(piece != ka.KING) & (piece != ka.KNIGHT)]] -= 1
+        # Arrests
+        m = kinds == 1
+        g, dst = games[m], targets[m]
+        self.arrested[g] |= np.left_shift(1, board[g, dst].astype(np.int16) - ka.VILLAGERCODE).astype(np.int16)
+        board[g, dst] = ka.EMPTY
+        self.knightsap[g] -= 1
+        # Kills
+        m = kinds == 2
+        g, dst, assassin = games[m], targets[m], pieces[m] == ka.ASSASSIN
+        self.killedknights[g[assassin]] += 1
+        self.peopleap[g[assassin]] -= 1
+        self.killedassassins[g[~assassin]] += 1
+        self.knightsap[g[~assassin]] -= 1
+        board[g, dst] = ka.EMPTY
+        # Attacks
+        g = games[kinds == 3]
+        self.king[g] = np.minimum(self.king[g] + 1, ka.DEAD)
+        self.peopleap[g] -= 1
+        # Reveals
+        m = kinds == REVEAL
+        board[games[m], cells[m]] = ka.ASSASSIN
+        # Ends of turns, player 0 drawing a new card
+        g = games[kinds == ENDKIND]
+        draw = g[self.player[g] == 0]
+        self.ncards[draw] -= 1
+        self.card[draw] = self.deck[draw, self.ncards[draw]]
+        self.kingap[g], self.knightsap[g], self.peopleap[g] = CARDAP[self.card[g]].T
+        self.player[g] = 1 - self.player[g]
+
+
+def _kinds(pieces, targets, kingsteps, player, kingap, knightsap, peopleap):
+    # Kind of the valid action (0 to 3 for a move, an arrest, a kill or an
+    # attack, -1 if none) of pieces towards targets (-1 off the board), at
+    # most one being valid, following KingAndAssassinsState._apply; the
+    # arguments are broadcast arrays, 'kingsteps' telling whether the king
+    # may step onto the target
+    king = (pieces == ka.KING) & (player == 1) & (kingap > 0) & kingsteps
+    knight = (pieces == ka.KNIGHT) & (player == 1) & (knightsap > 0)
+    people = (pieces >= ka.ASSASSIN) & (player == 0) & (peopleap > 0)
+    assassin = people & (pieces == ka.ASSASSIN)
+    move = (king | knight | people) & (targets == ka.EMPTY)
+    arrest = knight & (targets >= ka.VILLAGERCODE)
+    kill = (knight & (targets == ka.ASSASSIN)) | (assassin & (targets == ka.KNIGHT))
+    attack = assassin & (targets == ka.KING)
+    return (move + 2 * arrest + 3 * kill + 4 * attack).astype(np.int8) - 1
+
+
+def _reveals(pieces, player, assassins):
+    # Whether the pieces can be revealed, as broadcast arrays
+    villagers = np.where(pieces >= ka.VILLAGERCODE, pieces - ka.VILLAGERCODE, 0)
+    return (player == 0) & (pieces >= ka.VILLAGERCODE) & ((assassins >> villagers) & 1 == 1)
+
+
+def _kindtable():
+    # Kind of the valid action (see _kinds) for every context of a game (the
+    # player to play and which action points are left, see _actionkinds),
+    # class of the piece, class of its target and king's step, flattened
+    context, piece, target, kingstep = np.indices((16, len(CLASSCODES), len(CLASSCODES), 2)).reshape(4, -1)
+    codes = np.array(CLASSCODES, dtype=np.int16)
+    return _kinds(codes[piece], codes[target], kingstep == 1, context >> 3, context >> 2 & 1, context >> 1 & 1,
+                  context & 1)
+
+
+if np is not None:
+    # Class of every piece code (its index in CLASSCODES): empty, king,
+    # knight, assassin, villager, or off the board (the code OFFBOARD)
+    CLASSCODES = (ka.EMPTY, ka.KING, ka.KNIGHT, ka.ASSASSIN, ka.VILLAGERCODE, -1)
+    OFFBOARD = 255
+    CLASSES = np.full(256, CLASSCODES.index(ka.VILLAGERCODE), dtype=np.int16)
+    CLASSES[:ka.VILLAGERCODE] = range(ka.VILLAGERCODE)
+    CLASSES[OFFBOARD] = CLASSCODES.index(-1)
+    KINDTABLE = _kindtable()
+
+
+def crosscheck(games=64, seed=0, maxsteps=2000):
+    '''Check the batch engine against the scalar one.
+
+    Random games are played in lockstep by both engines, each step applying
+    in every game a valid action (END one time out of five) or, one time out
+    of four, any numbered action (mostly invalid ones). At every step, the
+    valid actions, the validity of the applied actions, the states and the
+    winners of both engines are compared.
+
+    Pre: -
+    Post: The returned value is the number of actions that have been
+          checked.
+    Raises AssertionError: If the engines disagree.
+    '''
+    rnd = random.Random(seed)
+    batch = BatchState.newgames([seed * games + i for i in range(games)])
+    states = [batch.tostate(i) for i in range(games)]
+    players = [1] * games
+    checked = 0
+    for step in range(maxsteps):
+        winners = batch.winner()
+        assert list(winners) == [state.winner() for state in states], 'winners differ at step {}'.format(step)
+        running = [i for i in range(games) if winners[i] == -1]
+        if len(running) == 0:
+            break
+        mask = batch.legalmask()
+        actions = np.full(games, END, dtype=np.int64)
+        for i in running:
+            legal = sorted(encode(action) for action in states[i].legal_actions(players[i]))
+            assert list(np.nonzero(mask[i, :END])[0]) == legal, 'legal actions differ in game {}'.format(i)
+            if rnd.random() < 0.25:
+                actions[i] = rnd.randrange(NBACTIONS)
+            elif len(legal) > 0 and rnd.random() >= 0.2:
+                actions[i] = rnd.choice(legal)
+        valid = batch.step(actions)
+        for i in running:
+            try:
+                states[i].apply(decode(actions[i]), players[i])
+                applied = True
+            except game.InvalidMoveException:
+                applied = False
+            assert valid[i] == applied, 'validity of {} differs in game {}'.format(decode(actions[i]), i)
+            if applied and actions[i] == END:
+                players[i] = 1 - players[i]
+            assert _fields(batch.tostate(i)) == _fields(states[i]), 'states differ in game {}'.format(i)
+            assert batch.player[i] == players[i]
+            checked += 1
+    return checked
+
+
+def _fields(state):
+    # What the batch engine keeps of a state
+    return (bytes(state.cells), state.card, state.king, state.killedknights, state.killedassassins,
+            state.arrested, state.assassins, state.cards, state.kingap, state.knightsap, state.peopleap)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins batch engine')
+    parser.add_argument('--games', help='number of games of the batch (default: 1024)', type=int, default=1024)
+    parser.add_argument('--seed', help='seed of the games (default: 0)', type=int, default=0)
+    parser.add_argument('--check', help='number of games cross-checked with the scalar engine (default: 64)',
+                        type=int, default=64)
+    args = parser.parse_args()
+
+    print('Cross-check: {} actions agree with the scalar engine.'.format(crosscheck(args.check, args.seed)))
+    batch = BatchState.newgames(range(args.seed * args.games, (args.seed + 1) * args.games))
+    start = time.perf_counter()
+    winners = batch.playout(np.random.default_rng(args.seed))
+    elapsed = time.perf_counter() - start
+    print('Random playouts: {} games in {:.2f} s ({:.0f} games/s), {} won by the king.'.format(
+        args.games, elapsed, args.games / elapsed, int((winners == 1).sum())))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# kaenv.py
+# Reset/step environments of the King & Assassins game, for training policies
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import kabatch
+import kingandassassins as ka
+from lib import game
+
+# Planes of the observations, each one a 10 x 10 array: the roofs and the
+# castle, one plane by piece code (the king, the knights, the revealed
+# assassins and each villager, in the order of PIECES), the villagers that
+# are assassins (only seen by player 0), then planes filled with the king's
+# health, the killed knights and assassins, the action points left and the
+# player to play
+PLANES = (('roof', 'castle') + ka.PIECES[1:] + ('hidden', 'king health', 'killed knights', 'killed assassins',
+                                                'king ap', 'knights ap', 'people ap', 'player'))
+NBPLANES = len(PLANES)
+HIDDEN = PLANES.index('hidden')
+NBACTIONS = kabatch.NBACTIONS
+
+if np is not None:
+    ROOFS = ~np.array(ka.TOPOLOGY.ground, dtype=bool).reshape(10, 10)
+    CASTLE = np.zeros((10, 10), dtype=bool)
+    for cell in ka.TOPOLOGY.castle:
+        CASTLE[divmod(cell, 10)] = True
+    CODES = np.arange(1, len(ka.PIECES), dtype=np.uint8)[:, None]
+
+
+def observe(state, player, out=None):
+    '''Get the observation of a game by a player.
+
+    Pre: 'state' is a KingAndAssassinsState and 'out', if not None, is a
+         NBPLANES x 10 x 10 array of uint8.
+    Post: The returned array (out, if given) holds the planes of PLANES seen
+          by 'player'. The assassins not revealed yet are only in player 0's
+          observation.
+    '''
+    if out is None:
+        out = np.empty((NBPLANES, 10, 10), dtype=np.uint8)
+    cells = np.frombuffer(bytes(state.cells), dtype=np.uint8)
+    out[0] = ROOFS
+    out[1] = CASTLE
+    out[2:HIDDEN] = (cells == CODES).reshape(-1, 10, 10)
+    out[HIDDEN] = 0
+    if player == 0 and state.assassins is not None:
+        villagers = cells >= ka.VILLAGERCODE
+        shifts = np.where(villagers, cells.astype(np.int16) - ka.VILLAGERCODE, 0)
+        out[HIDDEN] = (villagers & (state.assassins >> shifts & 1 == 1)).reshape(10, 10)
+    out[HIDDEN+1:] = np.array((state.king, state.killedknights, state.killedassassins,
+                               state.kingap, state.knightsap, state.peopleap, player), dtype=np.uint8)[:, None, None]
+    return out
+
+
+class KingAndAssassinsEnv:
+    '''Class representing a King & Assassins game played action by action.
+
+    reset() starts a new game, whose assassins are chosen from its seed (see
+    kabatch.newgame), and step() applies one action of the player to play,
+    numbered as in kabatch (END finishing the turn). Both return the
+    observation of the player to play next (see observe) and a dictionary
+    with that player, the mask of its valid actions (NBACTIONS booleans, the
+    ones of legal_actions and END) and the winner; step() also returns the
+    rewards of both players, 1 for the winner and -1 for the loser once the
+    game is over, and whether it is over (a game always ends, it is never
+    truncated).
+    '''
+    def __init__(self, seed=None):
+        if np is None:
+            raise ImportError('the environments need NumPy')
+        self.__rnd = random.Random(seed)
+        self.seed = None
+        self.state = None
+        self.player = None
+
+    def reset(self, seed=None, out=None):
+        '''Start a new game.
+
+        Pre: 'out', if not None, is an observation array (see observe).
+        Post: The game is the one of 'seed', or of a seed drawn from the one
+              of the environment if it is None. The returned value is the
+              pair (observation, info) for player 1, who plays first.
+        '''
+        self.seed = self.__rnd.getrandbits(63) if seed is None else seed
+        self.state = kabatch.newgame(self.seed)
+        self.player = 1
+        return observe(self.state, self.player, out), self._info()
+
+    def step(self, action, out=None):
+        '''Apply one action of the player to play.
+
+        Pre: The game is not over, 'out' is as for reset().
+        Post: The returned value is (observation, rewards, terminated,
+              truncated, info), the observation and info being the ones of
+              the player to play next.
+        Raises InvalidMoveException: If the action is invalid, in which case
+              the game is left unchanged.
+        '''
+        if self.state.winner() != -1:
+            raise game.InvalidMoveException('the game is over')
+        move = kabatch.decode(action)
+        self.state.apply(move, self.player)
+        if move == ka.END:
+            self.player = 1 - self.player
+        winner = self.state.winner()
+        rewards = np.zeros(2, dtype=np.float32)
+        if winner != -1:
+            rewards[winner] = 1
+            rewards[1 - winner] = -1
+        return observe(self.state, self.player, out), rewards, winner != -1, False, self._info()
+
+    def observe(self, player=None, out=None):
+        '''Get the observation of a player (by default, the one to play).'''
+        return observe(self.state, self.player if player is None else player, out)
+
+    def mask(self, out=None):
+        '''Get the mask of the valid actions of the player to play (all False once the game is over).'''
+        if out is None:
+            out = np.empty(NBACTIONS, dtype=bool)
+        out[:] = False
+        if self.state.winner() == -1:
+            out[[kabatch.encode(action) for action in self.state.legal_actions(self.player)]] = True
+            out[kabatch.END] = True
+        return out
+
+    def _info(self):
+        return {'player': self.player, 'mask': self.mask(), 'winner': self.state.winner()}
+
+
+class _Worker:
+    # Environments number 'first' to 'first + len(seeds) - 1' of a vector,
+    # writing their observations and masks in its shared buffers
+    def __init__(self, memory, size, first, seeds):
+        self.memory = memory
+        self.observations, self.masks = _buffers(memory, size)
+        self.first = first
+        self.envs = [KingAndAssassinsEnv(seed) for seed in seeds]
+
+    def reset(self, seeds):
+        players = []
+        for i, (env, seed) in enumerate(zip(self.envs, seeds)):
+            self.masks[self.first + i] = env.reset(seed, self.observations[self.first + i])[1]['mask']
+            players.append(env.player)
+        return players
+
+    def step(self, actions):
+        results = []
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            out = self.observations[self.first + i]
+            try:
+                observation, rewards, terminated, truncated, info = env.step(action, out)
+                # A game over is replaced by a new one
+                if terminated:
+                    info = env.reset(out=out)[1]
+                self.masks[self.first + i] = info['mask']
+                results.append((tuple(rewards), terminated, True, env.player))
+            except game.InvalidMoveException:
+                results.append(((0, 0), False, False, env.player))
+        return results
+
+    def close(self):
+        # The arrays must be released before the shared memory is closed
+        self.observations = self.masks = None
+        self.memory.close()
+
+
+def _buffers(memory, size):
+    # Observations and masks of 'size' environments in a shared memory
+    observations = np.ndarray((size, NBPLANES, 10, 10), dtype=np.uint8, buffer=memory.buf)
+    masks = np.ndarray((size, NBACTIONS), dtype=bool, buffer=memory.buf, offset=observations.nbytes)
+    return observations, masks
+
+
+def _serve(connection, name, size, first, seeds):
+    # Loop of a worker process, running the commands received from the vector
+    worker = _Worker(shared_memory.SharedMemory(name), size, first, seeds)
+    try:
+        while True:
+            command, argument = connection.recv()
+            if command == 'close':
+                break
+            connection.send(getattr(worker, command)(argument))
+    finally:
+        worker.close()
+        connection.close()
+
+
+class KingAndAssassinsVectorEnv:
+    '''Class representing N King & Assassins environments stepped together.
+
+    The environments are split between 'workers' processes, each one
+    stepping its share and writing their observations and action masks in
+    buffers shared with this process, so that they are never copied through
+    the pipes, which only carry the actions and the rewards. With no worker,
+    the environments are stepped in this process.
+
+    The observations and masks returned by reset() and step() are views of
+    the shared buffers, overwritten by the next call. A game over is
+    replaced by a new one at once: the step ending it returns the rewards of
+    its players, but the observation of the new game. An invalid action
+    leaves its environment unchanged, as told by info['valid'].
+    '''
+    def __init__(self, size, seed=None, workers=None):
+        if np is None:
+            raise ImportError('the environments need NumPy')
+        if workers is None:
+            workers = os.cpu_count()
+        workers = min(workers, size)
+        rnd = random.Random(seed)
+        seeds = [rnd.getrandbits(63) for i in range(size)]
+        self.size = size
+        self.__memory = shared_memory.SharedMemory(
+            create=True, size=size * (NBPLANES * 100 + NBACTIONS)
+        )
+        self.observations, self.masks = _buffers(self.__memory, size)
+        # Consecutive environments by worker
+        self.__slices = [(size * i // workers, size * (i + 1) // workers) for i in range(workers)]
+        self.__processes = []
+        self.__connections = []
+        self.__local = None
+        if workers == 0:
+            self.__local = _Worker(self.__memory, size, 0, seeds)
+        for first, last in self.__slices:
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, daemon=True,
+                                              args=(child, self.__memory.name, size, first, seeds[first:last]))
+            process.start()
+            child.close()
+            self.__processes.append(process)
+            self.__connections.append(connection)
+
+    def _run(self, command, arguments):
+        # Run a command with the arguments of each environment, and gather
+        # the results of all of them
+        if self.__local is not None:
+            return getattr(self.__local, command)(list(arguments))
+        for connection, (first, last) in zip(self.__connections, self.__slices):
+            connection.send((command, list(arguments[first:last])))
+        results = []
+        for connection in self.__connections:
+            results.extend(connection.recv())
+        return results
+
+    def reset(self, seed=None):
+        '''Start a new game in every environment.
+
+        Pre: -
+        Post: Environment i plays the game of seed seed*N+i, or of a seed
+              drawn from its own if 'seed' is None. The returned value is
+              (observations, info), info holding the players to play (all of
+              them 1) and the masks of their valid actions.
+        '''
+        seeds = [None if seed is None else seed * self.size + i for i in range(self.size)]
+        players = self._run('reset', seeds)
+        return self.observations, {'player': np.array(players, dtype=np.int8), 'mask': self.masks}
+
+    def step(self, actions):
+        '''Apply one action in every environment.
+
+        Pre: 'actions' holds N numbered actions, one for each environment.
+        Post: The returned value is (observations, rewards, terminated,
+              truncated, info), the rewards being a N x 2 array of the
+              rewards of both players, and info holding the players to play,
+              the masks of their valid actions and the validity of the
+              applied actions.
+        '''
+        results = self._run('step', [int(action) for action in actions])
+        rewards, terminated, valid, players = zip(*results)
+        return (self.observations, np.array(rewards, dtype=np.float32), np.array(terminated),
+                np.zeros(self.size, dtype=bool),
+                {'player': np.array(players, dtype=np.int8), 'mask': self.masks, 'valid': np.array(valid)})
+
+    def close(self):
+        '''Stop the workers and free the shared buffers.'''
+        if self.__memory is None:
+            return
+        for connection in self.__connections:
+            connection.send(('close', None))
+            connection.close()
+        for process in self.__processes:
+            process.join()
+        if self.__local is not None:
+            self.__local.observations = self.__local.masks = None
+        self.observations = self.masks = None
+        self.__memory.close()
+        self.__memory.unlink()
+        self.__memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins environments')
+    parser.add_argument('--envs', help='number of environments (default: 64)', type=int, default=64)
+    parser.add_argument('--workers', help='number of worker processes (default: number of CPUs)', type=int,
+                        default=os.cpu_count())
+    parser.add_argument('--steps', help='number of steps (default: 1000)', type=int, default=1000)
+    parser.add_argument('--seed', help='seed of the games and of the actions (default: 0)', type=int, default=0)
+    args = parser.parse_args()
+
+    # Random valid actions, as fast as the environments can step
+    rng = np.random.default_rng(args.seed)
+    with KingAndAssassinsVectorEnv(args.envs, args.seed, args.workers) as envs:
+        observations, info = envs.reset(args.seed)
+        games = [0, 0]
+        start = time.perf_counter()
+        for i in range(args.steps):
+            actions = np.argmax(rng.random(info['mask'].shape) * info['mask'], axis=1)
+            observations, rewards, terminated, truncated, info = envs.step(actions)
+            for winner in np.argmax(rewards[terminated], axis=1):
+                games[winner] += 1
+        elapsed = time.perf_counter() - start
+    print('{} steps of {} environments in {:.2f} s ({:.0f} actions/s)'.format(
+        args.steps, args.envs, elapsed, args.steps * args.envs / elapsed))
+    print('Games won by the assassins: {}, by the king: {}'.format(*games))
@@ -4,14 +4,25 @@
 # Version: April 29, 2016
 
 import argparse
+import concurrent.futures
+import itertools
 import json
+import os
 import random
 import socket
+import struct
 import sys
-from math import hypot
+import time
 from time import sleep
 
+from lib import belief
 from lib import game
+from lib import gamelog
+from lib import mcts
+from lib import metrics
+from lib import topology
+from lib import tournament
+from lib import transposition
 
 BUFFER_SIZE = 2048
 
@@ -52,6 +63,43 @@ BOARD = (
     ('R', 'R', 'G', 'G', 'G', 'G', 'G', 'G', 'G', 'G')
 )
 
+# Codes of the pieces, king's health, actions and directions in the binary
+# encoding of the states (see KingAndAssassinsState.pack)
+PIECES = (None, 'king', 'knight', 'assassin') + tuple(sorted(POPULATION))
+PIECECODES = {piece: code for code, piece in enumerate(PIECES)}
+EMPTY, KING, KNIGHT, ASSASSIN = range(4)
+VILLAGERCODE = 4
+NBASSASSINS = 3
+# Factor of the suspicion of a villager who moves towards the king
+SUSPICION = 1.25
+KINGSTATES = ('healthy', 'injured', 'dead')
+DEAD = KINGSTATES.index('dead')
+ACTIONS = ('move', 'arrest', 'kill', 'attack', 'reveal')
+# Pseudo-action finishing a turn (see KingAndAssassinsState.apply)
+END = ('end',)
+DIRS = ('N', 'E', 'S', 'W')
+NODIR = 255
+NOCARD = 255
+
+# people, card, king, killed knights and assassins, arrested villagers (bitmask)
+PACKED_STATE = struct.Struct('!100sBBBBH')
+# Number of actions of the last opponent's move, then each of them
+PACKED_COUNT = struct.Struct('!B')
+PACKED_ACTION = struct.Struct('!BbbB')
+
+# Binary encoding of the record of a game (see GameRecord): its header, then
+# for each turn the thinking time of the player (in microseconds) and the
+# count of its actions followed by them (as in PACKED_ACTION)
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct('!BQBH{}s{}sIH'.format(len(POPULATION), len(CARDS)))
+RECORD_TURN = struct.Struct('!I')
+NOWINNER = 255
+
+# Invalid moves in a row after which a bot loses by forfeit (see play_match)
+MAX_INVALID_MOVES = 10
+# Progressive widening of the searches of the MCTS bot (see mcts.MCTS)
+WIDENING = 0.25
+
 # Coordinates of pawns on the board
 KNIGHTS = {(1, 3), (3, 0), (7, 8), (8, 7), (8, 8), (8, 9), (9, 8)}
 VILLAGERS = {
@@ -59,40 +107,31 @@ VILLAGERS = {
     (5, 7), (5, 9), (7, 1), (7, 5), (8, 3), (9, 5)
 }
 
-# Separate board containing the position of the pawns
-PEOPLE = [[None for column in range(10)] for row in range(10)]
-
-# Place the king in the right-bottom corner
-PEOPLE[9][9] = 'king'
-
-# Place the knights on the board
-for coord in KNIGHTS:
-    PEOPLE[coord[0]][coord[1]] = 'knight'
-
-# Place the villagers on the board
-# random.sample(A, len(A)) returns a list where the elements are shuffled
-# this randomizes the position of the villagers
-for villager, coord in zip(random.sample(POPULATION, len(POPULATION)), VILLAGERS):
-    PEOPLE[coord[0]][coord[1]] = villager
-
-KA_INITIAL_STATE = {
-    'board': BOARD,
-    'people': PEOPLE,
-    'castle': [(2, 2, 'N'), (4, 1, 'W')],
-    'card': None,
-    'king': 'healthy',
-    'lastopponentmove': [],
-    'arrested': [],
-    'killed': {
-        'knights': 0,
-        'assassins': 0
-    }
-}
+# Cells in front of the doors of the castle, and the direction of the step
+# entering it
+CASTLE = ((2, 2, 'N'), (4, 1, 'W'))
 
 
 class KingAndAssassinsState(game.GameState):
-    '''Class representing a state for the King & Assassins game.'''
-    
+    '''Class representing a state for the King & Assassins game.
+
+    The people are stored in a flat bytearray of 100 cells (cell x*10+y)
+    holding piece codes (see PIECES), along with indexes of the positions of
+    the king, the knights, the villagers and the revealed assassins, which
+    are kept up to date as the actions are applied. The dictionary form of
+    the state is still available (built on demand) through _state.
+
+    The Zobrist hash of the visible position (people, arrested villagers,
+    killed people, king's health and card) is kept up to date the same way,
+    in 'hashkey' (see zobrist).
+    '''
+
+    __slots__ = (
+        'cells', 'card', 'king', 'killedknights', 'killedassassins', 'arrested',
+        'lastopponentmove', 'assassins', 'cards', 'kingpos', 'knights', 'villagers', 'revealed',
+        'kingap', 'knightsap', 'peopleap', 'hashkey'
+    )
+
     DIRECTIONS = {
         'E': (0, 1),
         'W': (0, -1),
@@ -100,131 +139,525 @@ class KingAndAssassinsState(game.GameState):
         'N': (-1, 0)
     }
 
-    def __init__(self, initialstate=KA_INITIAL_STATE):
-        super().__init__(initialstate)
-    
-    def _nextfree(self, x, y, dir):
-        nx, ny = self._getcoord((x, y, dir))
+    def __init__(self, initialstate=None, hidden=None):
+        # Without any initial state, the one of a new game (villagers placed
+        # at random), but not its hidden part
+        if initialstate is None:
+            initialstate = _initialstate(random.Random())[0]
+        super().__init__(initialstate, hidden)
+
+    @property
+    def _state(self):
+        visible = {
+            'board': BOARD,
+            'people': [[PIECES[code] for code in self.cells[i:i+10]] for i in range(0, 100, 10)],
+            'castle': CASTLE,
+            'card': None if self.card is None else list(CARDS[self.card]),
+            'king': KINGSTATES[self.king],
+            'lastopponentmove': self.lastopponentmove,
+            'arrested': [PIECES[VILLAGERCODE + i] for i in range(len(POPULATION)) if self.arrested >> i & 1],
+            'killed': {
+                'knights': self.killedknights,
+                'assassins': self.killedassassins
+            }
+        }
+        hidden = None
+        if self.cards is not None:
+            hidden = {
+                'assassins': None if self.assassins is None else [
+                    PIECES[VILLAGERCODE + i] for i in range(len(POPULATION)) if self.assassins >> i & 1
+                ],
+                'cards': [CARDS[card] for card in self.cards]
+            }
+        return {'visible': visible, 'hidden': hidden}
+
+    @_state.setter
+    def _state(self, state):
+        visible, hidden = state['visible'], state['hidden']
+        self.cells = bytearray(PIECECODES[p] for row in visible['people'] for p in row)
+        self.card = None if visible['card'] is None else CARDS.index(tuple(visible['card']))
+        self.king = KINGSTATES.index(visible['king'])
+        self.killedknights = visible['killed']['knights']
+        self.killedassassins = visible['killed']['assassins']
+        self.arrested = _villagersmask(visible['arrested'])
+        self.lastopponentmove = list(visible['lastopponentmove'])
+        self.assassins = None
+        self.cards = None
+        if hidden is not None:
+            if hidden['assassins'] is not None:
+                self.assassins = _villagersmask(hidden['assassins'])
+            self.cards = [CARDS.index(tuple(card)) for card in hidden['cards']]
+        self._index()
+        self._resetap()
+
+    def __str__(self):
+        # Same as encoding self._state['visible'], but without building it and
+        # with the constant parts encoded once for all
+        cells = self.cells
+        return ''.join((
+            '{"board":', _JSON['board'],
+            ',"people":[', ','.join(['[' + ','.join([_JSON['pieces'][code] for code in cells[i:i+10]]) + ']'
+                                     for i in range(0, 100, 10)]),
+            '],"castle":', _JSON['castle'],
+            ',"card":', 'null' if self.card is None else _JSON['cards'][self.card],
+            ',"king":', _JSON['king'][self.king],
+            ',"lastopponentmove":', json.dumps(self.lastopponentmove, separators=(',', ':')),
+            ',"arrested":[', ','.join([_JSON['pieces'][VILLAGERCODE + i] for i in range(len(POPULATION))
+                                       if self.arrested >> i & 1]),
+            '],"killed":{"knights":', str(self.killedknights), ',"assassins":', str(self.killedassassins), '}}'
+        ))
+
+    def _index(self):
+        # Rebuild the indexes of the positions of the pieces from the cells,
+        # and the Zobrist hash from all the fields
+        self.kingpos = -1
+        self.knights = set()
+        self.villagers = set()
+        self.revealed = set()
+        hashkey = 0
+        for cell in range(100):
+            self._indexcell(cell, self.cells[cell])
+            hashkey ^= _ZOBRIST_CELLS[cell][self.cells[cell]]
+        for i in range(len(POPULATION)):
+            if self.arrested >> i & 1:
+                hashkey ^= _ZOBRIST_ARRESTED[i]
+        self.hashkey = (hashkey ^ _ZOBRIST_KING[self.king] ^ _ZOBRIST_KNIGHTS[self.killedknights]
+                        ^ _ZOBRIST_ASSASSINS[self.killedassassins] ^ _zobristcard(self.card))
+
+    def _indexcell(self, cell, code):
+        if code == KING:
+            self.kingpos = cell
+        elif code == KNIGHT:
+            self.knights.add(cell)
+        elif code == ASSASSIN:
+            self.revealed.add(cell)
+        elif code != EMPTY:
+            self.villagers.add(cell)
+
+    def _setcell(self, cell, code):
+        old = self.cells[cell]
+        if old == KING:
+            self.kingpos = -1
+        elif old == KNIGHT:
+            self.knights.discard(cell)
+        elif old == ASSASSIN:
+            self.revealed.discard(cell)
+        elif old != EMPTY:
+            self.villagers.discard(cell)
+        self.cells[cell] = code
+        self.hashkey ^= _ZOBRIST_CELLS[cell][old] ^ _ZOBRIST_CELLS[cell][code]
+        self._indexcell(cell, code)
+
+    def _move(self, src, dst):
+        code = self.cells[src]
+        self._setcell(src, EMPTY)
+        self._setcell(dst, code)
+
+    def copy(self, hidden=True):
+        '''Get a copy of this state, sharing nothing mutable with it.
+
+        Pre: -
+        Post: The returned value is a copy of this state, without its hidden
+              part if 'hidden' is False.
+        '''
+        state = KingAndAssassinsState.__new__(KingAndAssassinsState)
+        state.cells = bytearray(self.cells)
+        state.card = self.card
+        state.king = self.king
+        state.killedknights = self.killedknights
+        state.killedassassins = self.killedassassins
+        state.arrested = self.arrested
+        state.lastopponentmove = list(self.lastopponentmove)
+        state.assassins = self.assassins if hidden else None
+        state.cards = list(self.cards) if hidden and self.cards is not None else None
+        state.kingpos = self.kingpos
+        state.knights = set(self.knights)
+        state.villagers = set(self.villagers)
+        state.revealed = set(self.revealed)
+        state.kingap = self.kingap
+        state.knightsap = self.knightsap
+        state.peopleap = self.peopleap
+        state.hashkey = self.hashkey
+        return state
+
+    def __getstate__(self):
+        # Pickling and deep copies save the fields themselves: the default
+        # would save the '_state' dictionary, which loses the action points
+        # left in the current turn
+        return tuple(getattr(self, name) for name in KingAndAssassinsState.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(KingAndAssassinsState.__slots__, state):
+            setattr(self, name, value)
+
+    def piece(self, x, y):
+        '''Get the name of the piece at position (x, y), None if the cell is free.'''
+        return PIECES[self.cells[x * 10 + y]]
+
+    def _cellof(self, move, x, y):
+        if not (0 <= x < 10 and 0 <= y < 10):
+            raise game.InvalidMoveException('{}: out of the board'.format(move))
+        return x * 10 + y
+
+    def _targetof(self, move, cell, d):
+        if d not in TOPOLOGY.steps:
+            raise game.InvalidMoveException('{}: unknown direction'.format(move))
+        target = TOPOLOGY.steps[d][cell]
+        if target == -1:
+            raise game.InvalidMoveException('{}: out of the board'.format(move))
+        return target
+
+    def _setcard(self, card):
+        self.hashkey ^= _zobristcard(self.card) ^ _zobristcard(card)
+        self.card = card
+
+    def zobrist(self):
+        '''Get the Zobrist hash of this state.
+
+        Pre: -
+        Post: The returned value is a 64-bit integer hash of the visible
+              position and of the action points left in the current turn.
+              It is maintained incrementally as the actions are applied and
+              undone.
+        '''
+        return (self.hashkey ^ _ZOBRIST_AP[0][self.kingap] ^ _ZOBRIST_AP[1][self.knightsap]
+                ^ _ZOBRIST_AP[2][self.peopleap])
+
+    def _resetap(self):
+        # Action points of a new turn, given by the current card
+        if self.card is None:
+            self.kingap, self.knightsap, self.peopleap = 0, 0, 0
+        else:
+            card = CARDS[self.card]
+            self.kingap, self.knightsap, self.peopleap = card[0], card[1], card[3]
+
+    def _spend(self, move, code):
+        # Spend one action point for an action of the piece 'code'
+        if code == KING:
+            if self.kingap == 0:
+                raise game.InvalidMoveException('{}: no action point left for the king'.format(move))
+            self.kingap -= 1
+        elif code == KNIGHT:
+            if self.knightsap == 0:
+                raise game.InvalidMoveException('{}: no action point left for the knights'.format(move))
+            self.knightsap -= 1
+        else:
+            if self.peopleap == 0:
+                raise game.InvalidMoveException('{}: no action point left for the people'.format(move))
+            self.peopleap -= 1
+
+    def _apply(self, move, player):
+        # Check and apply one action of 'player', spending its action points
+        cells = self.cells
+        # ('move', x, y, dir): moves person at position (x,y) of one cell in direction dir
+        if move[0] == 'move':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            src = self._cellof(move, x, y)
+            p = cells[src]
+            if p == EMPTY:
+                raise game.InvalidMoveException('{}: there is no one to move'.format(move))
+            dst = self._targetof(move, src, d)
+            # Everyone can only move on a free cell
+            if cells[dst] != EMPTY:
+                raise game.InvalidMoveException('{}: cannot move on a cell that is not free'.format(move))
+            # The only roofs the king can go on are the castle's, through its doors
+            if p == KING and not TOPOLOGY.ground[dst] and (src, d) not in TOPOLOGY.entries:
+                raise game.InvalidMoveException('{}: the king cannot move on a roof'.format(move))
+            if p in (KING, KNIGHT) and player != 1:
+                raise game.InvalidMoveException('{}: the king and knights can only be moved by player 1'.format(move))
+            if p not in (KING, KNIGHT) and player != 0:
+                raise game.InvalidMoveException('{}: villagers and assassins can only be moved by player 0'.format(move))
+            self._spend(move, p)
+            self._move(src, dst)
+        # ('arrest', x, y, dir): arrests the villager in direction dir with knight at position (x, y)
+        elif move[0] == 'arrest':
+            if player != 1:
+                raise game.InvalidMoveException('arrest action only possible for player 1')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            cell = self._cellof(move, x, y)
+            if cells[cell] != KNIGHT:
+                raise game.InvalidMoveException('{}: the attacker is not a knight'.format(move))
+            target = self._targetof(move, cell, d)
+            if cells[target] < VILLAGERCODE:
+                raise game.InvalidMoveException('{}: only villagers can be arrested'.format(move))
+            self._spend(move, KNIGHT)
+            self.arrested |= 1 << (cells[target] - VILLAGERCODE)
+            self.hashkey ^= _ZOBRIST_ARRESTED[cells[target] - VILLAGERCODE]
+            self._setcell(target, EMPTY)
+        # ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
+        elif move[0] == 'kill':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            cell = self._cellof(move, x, y)
+            killer = cells[cell]
+            if killer == ASSASSIN and player != 0:
+                raise game.InvalidMoveException('{}: kill action for assassin only possible for player 0'.format(move))
+            if killer == KNIGHT and player != 1:
+                raise game.InvalidMoveException('{}: kill action for knight only possible for player 1'.format(move))
+            target = self._targetof(move, cell, d)
+            if cells[target] == EMPTY:
+                raise game.InvalidMoveException('{}: there is no one to kill'.format(move))
+            if killer == ASSASSIN and cells[target] == KNIGHT:
+                self._spend(move, ASSASSIN)
+                self.hashkey ^= _ZOBRIST_KNIGHTS[self.killedknights] ^ _ZOBRIST_KNIGHTS[self.killedknights + 1]
+                self.killedknights += 1
+            elif killer == KNIGHT and cells[target] == ASSASSIN:
+                self._spend(move, KNIGHT)
+                self.hashkey ^= _ZOBRIST_ASSASSINS[self.killedassassins] ^ _ZOBRIST_ASSASSINS[self.killedassassins + 1]
+                self.killedassassins += 1
+            else:
+                raise game.InvalidMoveException('{}: forbidden kill'.format(move))
+            self._setcell(target, EMPTY)
+        # ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
+        elif move[0] == 'attack':
+            if player != 0:
+                raise game.InvalidMoveException('attack action only possible for player 0')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            cell = self._cellof(move, x, y)
+            if cells[cell] != ASSASSIN:
+                raise game.InvalidMoveException('{}: the attacker is not an assassin'.format(move))
+            if cells[self._targetof(move, cell, d)] != KING:
+                raise game.InvalidMoveException('{}: only the king can be attacked'.format(move))
+            self._spend(move, ASSASSIN)
+            king = min(self.king + 1, DEAD)
+            self.hashkey ^= _ZOBRIST_KING[self.king] ^ _ZOBRIST_KING[king]
+            self.king = king
+        # ('reveal', x, y): reveals villager at position (x,y) as an assassin (for free)
+        elif move[0] == 'reveal':
+            if player != 0:
+                raise game.InvalidMoveException('raise action only possible for player 0')
+            x, y = int(move[1]), int(move[2])
+            cell = self._cellof(move, x, y)
+            p = cells[cell]
+            # Without the hidden part (client side), reveals are trusted
+            if self.assassins is not None and (p < VILLAGERCODE or not self.assassins >> (p - VILLAGERCODE) & 1):
+                raise game.InvalidMoveException('{}: the specified villager is not an assassin'.format(move))
+            self._setcell(cell, ASSASSIN)
+        else:
+            raise game.InvalidMoveException('{}: unknown action'.format(move))
+
+    def apply(self, action, player):
+        '''Apply one action, or END to finish the turn.
+
+        Pre: -
+        Post: 'action' has been applied for 'player', and the returned value
+              is the record to give to undo to restore this state exactly.
+              Finishing the turn of player 0 draws a new card (if the deck is
+              known) and every END gives the action points of the new turn.
+        Raises InvalidMoveException: If 'action' is invalid, in which case
+              this state is left unchanged, including if it is malformed.
+        '''
+        if action == END:
+            # If assassins' team just played, draw a new card (on the server side)
+            draw = player == 0 and self.cards is not None
+            record = ('end', self.card, draw, self.kingap, self.knightsap, self.peopleap)
+            if draw:
+                self._setcard(self.cards.pop())
+            self._resetap()
+            return record
+        _checkaction(action)
+        cell, target = _cells(action)
+        cells = self.cells
+        record = (
+            cell, cells[cell], target, cells[target],
+            self.kingap, self.knightsap, self.peopleap,
+            self.arrested, self.king, self.killedknights, self.killedassassins
+        )
+        self._apply(action, player)
+        return record
+
+    def undo(self, record):
+        '''Undo an action applied by apply, given the record it returned.
+
+        Pre: 'record' is the last record returned by apply on this state that
+             has not been undone yet.
+        Post: This state is exactly as it was before the action.
+        '''
+        if record[0] == 'end':
+            card, draw, self.kingap, self.knightsap, self.peopleap = record[1:]
+            if draw:
+                self.cards.append(self.card)
+            self._setcard(card)
+        else:
+            cell, code, target, targetcode = record[:4]
+            self._setcell(target, targetcode)
+            self._setcell(cell, code)
+            arrested, king, killedknights, killedassassins = record[7:]
+            # An action changes at most one villager's arrest
+            if arrested != self.arrested:
+                self.hashkey ^= _ZOBRIST_ARRESTED[(arrested ^ self.arrested).bit_length() - 1]
+            self.hashkey ^= (_ZOBRIST_KING[self.king] ^ _ZOBRIST_KING[king]
+                             ^ _ZOBRIST_KNIGHTS[self.killedknights] ^ _ZOBRIST_KNIGHTS[killedknights]
+                             ^ _ZOBRIST_ASSASSINS[self.killedassassins] ^ _ZOBRIST_ASSASSINS[killedassassins])
+            (self.kingap, self.knightsap, self.peopleap,
+             self.arrested, self.king, self.killedknights, self.killedassassins) = record[4:]
 
     def update(self, moves, player):
-        visible = self._state['visible']
-        hidden = self._state['hidden']
-        people = visible['people']
-        for move in moves:
-            # ('move', x, y, dir): moves person at position (x,y) of one cell in direction dir
-            if move[0] == 'move':
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                p = people[x][y]
-                if p is None:
-                    raise game.InvalidMoveException('{}: there is no one to move'.format(move))
-                nx, ny = self._getcoord((x, y, d))
-                new = people[nx][ny]
-                # King, assassins, villagers can only move on a free cell
-                if p != 'knight' and new is not None:
-                    raise game.InvalidMoveException('{}: cannot move on a cell that is not free'.format(move))
-                if p == 'king' and BOARD[nx][ny] == 'R':
-                    raise game.InvalidMoveException('{}: the king cannot move on a roof'.format(move))
-                if p in {'assassin'} and p in POPULATION and player != 0:
-                    raise game.InvalidMoveException('{}: villagers and assassins can only be moved by player 0'.format(move))
-                if p in {'king', 'knight'} and player != 1:
-                    raise game.InvalidMoveException('{}: the king and knights can only be moved by player 1'.format(move))
-                # Move granted if cell is free
-                if new is None:
-                    people[x][y], people[nx][ny] = people[nx][ny], people[x][y]
-                # If cell is not free, check if the knight can push villagers
-                else:
-                    pass
-            # ('arrest', x, y, dir): arrests the villager in direction dir with knight at position (x, y)
-            elif move[0] == 'arrest':
-                if player != 1:
-                    raise game.InvalidMoveException('arrest action only possible for player 1')
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                arrester = people[x][y]
-                if arrester != 'knight':
-                    raise game.InvalidMoveException('{}: the attacker is not a knight'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target not in POPULATION:
-                    raise game.InvalidMoveException('{}: only villagers can be arrested'.format(move))
-                visible['arrested'].append(people[tx][ty])
-                people[tx][ty] = None
-            # ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
-            elif move[0] == 'kill':
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                killer = people[x][y]
-                if killer == 'assassin' and player != 0:
-                    raise game.InvalidMoveException('{}: kill action for assassin only possible for player 0'.format(move))
-                if killer == 'knight' and player != 1:
-                    raise game.InvalidMoveException('{}: kill action for knight only possible for player 1'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target is None:
-                    raise game.InvalidMoveException('{}: there is no one to kill'.format(move))
-                if killer == 'assassin' and target == 'knight':
-                    visible['killed']['knights'] += 1
-                    people[tx][tx] = None
-                elif killer == 'knight' and target == 'assassin':
-                    visible['killed']['assassins'] += 1
-                    people[tx][tx] = None
+        # The actions are applied atomically, all of them or none of them
+        if not isinstance(moves, list):
+            raise game.InvalidMoveException('{}: the actions must be a list'.format(moves))
+        self._resetap()
+        records = []
+        try:
+            for move in moves:
+                # The turn is only finished below, not by the moves
+                _checkaction(move)
+                records.append(self.apply(move, player))
+        except game.InvalidMoveException:
+            for record in reversed(records):
+                self.undo(record)
+            self._resetap()
+            raise
+        self.apply(END, player)
+
+    def legal_actions(self, player):
+        '''Get all the valid single actions for a player.
+
+        Pre: -
+        Post: The returned value contains the list of the actions (in the same
+              form as the ones of a move) that 'player' can play now, given
+              the action points it has left in the current turn. Reveals are
+              only listed if the assassins are known by this state.
+        '''
+        cells = self.cells
+        actions = []
+        if player == 1:
+            if self.kingap > 0 and self.kingpos != -1:
+                for d, target in TOPOLOGY.neighbours[self.kingpos]:
+                    if cells[target] == EMPTY and (TOPOLOGY.ground[target] or (self.kingpos, d) in TOPOLOGY.entries):
+                        actions.append(_ACTIONS['move'][self.kingpos][d])
+            if self.knightsap > 0:
+                for cell in sorted(self.knights):
+                    for d, target in TOPOLOGY.neighbours[cell]:
+                        code = cells[target]
+                        if code == EMPTY:
+                            actions.append(_ACTIONS['move'][cell][d])
+                        elif code >= VILLAGERCODE:
+                            actions.append(_ACTIONS['arrest'][cell][d])
+                        elif code == ASSASSIN:
+                            actions.append(_ACTIONS['kill'][cell][d])
+        else:
+            if self.peopleap > 0:
+                for cell in sorted(self.villagers | self.revealed):
+                    assassin = cells[cell] == ASSASSIN
+                    for d, target in TOPOLOGY.neighbours[cell]:
+                        code = cells[target]
+                        if code == EMPTY:
+                            actions.append(_ACTIONS['move'][cell][d])
+                        elif assassin and code == KNIGHT:
+                            actions.append(_ACTIONS['kill'][cell][d])
+                        elif assassin and code == KING:
+                            actions.append(_ACTIONS['attack'][cell][d])
+            if self.assassins is not None:
+                for cell in sorted(self.villagers):
+                    if self.assassins >> (cells[cell] - VILLAGERCODE) & 1:
+                        actions.append(_ACTIONS['reveal'][cell])
+        return actions
+
+    def turns(self, player):
+        '''Generate the complete turns a player can play.
+
+        Pre: -
+        Post: The generated values are lists of actions, each of which is a
+              valid move for 'player' from this state. A turn is generated for
+              every distinct resulting state, starting with the empty turn.
+              While the generator runs, this state is the one reached by the
+              last generated turn; it is restored when the generator ends.
+        '''
+        # Action points left with which each position has been explored, a
+        # position reached again with no more points than before is pruned.
+        # The search is done in place, with apply and undo.
+        explored = {}
+        actions, records = [], []
+        stack = []
+        visit = True
+        try:
+            while True:
+                if visit:
+                    key, ap = self._turnkey()
+                    pruned = False
+                    if key in explored:
+                        pruned = any(all(a >= b for a, b in zip(other, ap)) for other in explored[key])
+                        if not pruned:
+                            explored[key].append(ap)
+                    else:
+                        explored[key] = [ap]
+                        yield list(actions)
+                    stack.append(iter(() if pruned else self.legal_actions(player)))
+                action = next(stack[-1], None)
+                if action is not None:
+                    records.append(self.apply(action, player))
+                    actions.append(action)
+                    visit = True
+                elif len(records) > 0:
+                    stack.pop()
+                    self.undo(records.pop())
+                    actions.pop()
+                    visit = False
                 else:
-                    raise game.InvalidMoveException('{}: forbidden kill'.format(move))
-            # ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
-            elif move[0] == 'attack':
-                if player != 0:
-                    raise game.InvalidMoveException('attack action only possible for player 0')
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                attacker = people[x][y]
-                if attacker != 'assassin':
-                    raise game.InvalidMoveException('{}: the attacker is not an assassin'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target != 'king':
-                    raise game.InvalidMoveException('{}: only the king can be attacked'.format(move))
-                visible['king'] = 'injured' if visible['king'] == 'healthy' else 'dead'
-            # ('reveal', x, y): reveals villager at position (x,y) as an assassin
-            elif move[0] == 'reveal':
-                if player != 0:
-                    raise game.InvalidMoveException('raise action only possible for player 0')
-                x, y = int(move[1]), int(move[2])
-                p = people[x][y]
-                if p not in hidden['assassins']:
-                    raise game.InvalidMoveException('{}: the specified villager is not an assassin'.format(move))
-                people[x][y] = 'assassin'
-        # If assassins' team just played, draw a new card
+                    return
+        finally:
+            for record in reversed(records):
+                self.undo(record)
+
+    def _turnkey(self):
+        # Position reached within a turn, and the action points left
+        return (
+            (bytes(self.cells), self.arrested, self.king, self.killedknights, self.killedassassins),
+            (self.kingap, self.knightsap, self.peopleap)
+        )
+
+    def delta(self):
+        return json.dumps({
+            'card': None if self.card is None else CARDS[self.card],
+            'lastopponentmove': self.lastopponentmove
+        }, separators=(',', ':'))
+
+    def applydelta(self, delta, player, move):
+        delta = json.loads(delta)
+        # Our own move (the choice of the assassins does not change the
+        # visible state) and then the opponent's one
+        move = json.loads(move)
+        card = None if delta['card'] is None else CARDS.index(tuple(delta['card']))
+        if 'actions' in move:
+            self.update(move['actions'], player)
+        # The end of the assassins' turn drew the card the king's team has
+        # played with, the one of the delta
         if player == 0:
-            visible['card'] = hidden['cards'].pop()
+            self._setcard(card)
+        self.update(delta['lastopponentmove'], 1 - player)
+        self.lastopponentmove = delta['lastopponentmove']
+        self._setcard(card)
+        self._resetap()
 
     def _getcoord(self, coord):
-        return tuple(coord[i] + KingAndAssassinsState.DIRECTIONS[coord[2]][i] for i in range(2))
+        dx, dy = KingAndAssassinsState.DIRECTIONS[coord[2]]
+        return coord[0] + dx, coord[1] + dy
 
     def winner(self):
-        visible = self._state['visible']
-        hidden = self._state['hidden']
         # The king reached the castle
-        for doors in visible['castle']:
-            coord = self._getcoord(doors)
-            if visible['people'][coord[0]][coord[1]] == 'king':
-                return 1
+        if self.kingpos in TOPOLOGY.castle:
+            return 1
         # The are no more cards
-        if len(hidden['cards']) == 0:
+        if self.cards is not None and len(self.cards) == 0:
             return 0
         # The king has been killed
-        if visible['king'] == 'dead':
+        if self.king == DEAD:
             return 0
         # All the assassins have been arrested or killed
-        if visible['killed']['assassins'] + len(set(visible['arrested']) & hidden['assassins']) == 3:
+        if self.assassins is not None and self.killedassassins + bin(self.arrested & self.assassins).count('1') == NBASSASSINS:
             return 1
         return -1
 
     def isinitial(self):
-        return self._state['hidden']['assassins'] is None
-    
+        return self.assassins is None
+
     def setassassins(self, assassins):
-        self._state['hidden']['assassins'] = set(assassins)
+        self.assassins = _villagersmask(assassins)
 
     def prettyprint(self):
-        visible = self._state['visible']
-        hidden = self._state['hidden']
+        state = self._state
+        visible = state['visible']
+        hidden = state['hidden']
         result = ''
         if hidden is not None:
             result += '   - Assassins: {}\n'.format(hidden['assassins'])
@@ -238,43 +671,568 @@ class KingAndAssassinsState(game.GameState):
             result += '   +{}\n'.format(''.join(['----+' if e == 'G' else '^^^^+' for e in visible['board'][i]]))
         print(result)
 
+    def pack(self):
+        data = bytearray(PACKED_STATE.pack(
+            bytes(self.cells),
+            NOCARD if self.card is None else self.card,
+            self.king,
+            self.killedknights,
+            self.killedassassins,
+            self.arrested
+        ))
+        data += _packactions(self.lastopponentmove)
+        return bytes(data)
+
+    @classmethod
+    def unpack(cls, data):
+        people, card, king, knights, assassins, arrested = PACKED_STATE.unpack_from(data)
+        lastopponentmove = _unpackactions(data, PACKED_STATE.size)[0]
+        state = cls.__new__(cls)
+        state.cells = bytearray(people)
+        state.card = None if card == NOCARD else card
+        state.king = king
+        state.killedknights = knights
+        state.killedassassins = assassins
+        state.arrested = arrested
+        state.lastopponentmove = lastopponentmove
+        state.assassins = None
+        state.cards = None
+        state._index()
+        state._resetap()
+        return state
+
     @classmethod
     def buffersize(cls):
         return BUFFER_SIZE
 
 
+# Static topology of the board: neighbours, roofs and castle doors (the king
+# wins by entering the castle through one of its doors)
+TOPOLOGY = topology.Topology(BOARD, KingAndAssassinsState.DIRECTIONS, CASTLE)
+# Number of steps the king needs to enter the castle from each cell when no
+# one is in the way (see lib/topology.py for the ones around the people)
+CASTLE_DISTANCES = tuple(topology.DistanceField(TOPOLOGY).distances)
+# Cells next to each cell
+NEIGHBOURS = tuple(frozenset(n for d, n in TOPOLOGY.neighbours[cell]) for cell in range(100))
+
+
+# Prebuilt actions: _ACTIONS[kind][cell][d] is the action of the piece at
+# 'cell' in direction d, and _ACTIONS['reveal'][cell] the reveal of 'cell'
+_ACTIONS = {
+    kind: tuple(
+        {d: (kind, cell // 10, cell % 10, d) for d, target in TOPOLOGY.neighbours[cell]}
+        for cell in range(100)
+    )
+    for kind in ('move', 'arrest', 'kill', 'attack')
+}
+_ACTIONS['reveal'] = tuple(('reveal', cell // 10, cell % 10) for cell in range(100))
+# Every action of a move with the right shape, valid or not (see
+# _checkaction), but END: only update() finishes a turn
+_WELLFORMED = frozenset(
+    [(kind, x, y, d) for kind in ('move', 'arrest', 'kill', 'attack') for x in range(10) for y in range(10)
+     for d in DIRS] + [('reveal', x, y) for x in range(10) for y in range(10)]
+)
+
+
+# JSON encoding of the constant parts of the states (see KingAndAssassinsState.__str__)
+_JSON = {
+    'board': json.dumps(BOARD, separators=(',', ':')),
+    'castle': json.dumps(CASTLE, separators=(',', ':')),
+    'pieces': [json.dumps(piece) for piece in PIECES],
+    'cards': [json.dumps(card, separators=(',', ':')) for card in CARDS],
+    'king': [json.dumps(king) for king in KINGSTATES]
+}
+
+
+# Keys of the Zobrist hashes of the states (see KingAndAssassinsState.zobrist),
+# from a fixed seed so that the hashes are the same in every process. The
+# key of an empty cell is 0.
+_ZOBRIST_RANDOM = random.Random(0x5A0B)
+_ZOBRIST_CELLS = tuple(
+    (0,) + tuple(_ZOBRIST_RANDOM.getrandbits(64) for code in range(1, len(PIECES))) for cell in range(100)
+)
+_ZOBRIST_ARRESTED = tuple(_ZOBRIST_RANDOM.getrandbits(64) for villager in POPULATION)
+_ZOBRIST_KING = tuple(_ZOBRIST_RANDOM.getrandbits(64) for king in KINGSTATES)
+_ZOBRIST_KNIGHTS = tuple(_ZOBRIST_RANDOM.getrandbits(64) for killed in range(len(KNIGHTS) + 1))
+_ZOBRIST_ASSASSINS = tuple(_ZOBRIST_RANDOM.getrandbits(64) for killed in range(4))
+_ZOBRIST_CARDS = tuple(_ZOBRIST_RANDOM.getrandbits(64) for card in CARDS)
+_ZOBRIST_AP = tuple(
+    tuple(_ZOBRIST_RANDOM.getrandbits(64) for ap in range(max(card[i] for card in CARDS) + 1)) for i in (0, 1, 3)
+)
+
+
+def _zobristcard(card):
+    return 0 if card is None else _ZOBRIST_CARDS[card]
+
+
+def _checkaction(action):
+    # Check the shape of an action: a known kind, then coordinates on the
+    # board and a known direction, as many of them as the kind needs
+    try:
+        if tuple(action) in _WELLFORMED:
+            return
+    except TypeError:
+        pass
+    raise game.InvalidMoveException('{}: malformed action'.format(action))
+
+
+def _cells(action):
+    # Cells an action may modify: the one of the acting piece and its target
+    x, y = int(action[1]), int(action[2])
+    if not (0 <= x < 10 and 0 <= y < 10):
+        return 0, 0
+    cell = x * 10 + y
+    if len(action) > 3 and action[3] in TOPOLOGY.steps and TOPOLOGY.steps[action[3]][cell] != -1:
+        return cell, TOPOLOGY.steps[action[3]][cell]
+    return cell, cell
+
+
+def _step(coord):
+    # Coordinates of the next cell in the direction coord[2], (-1, -1) if off board
+    cell = TOPOLOGY.steps[coord[2]][coord[0] * 10 + coord[1]]
+    return (-1, -1) if cell == -1 else divmod(cell, 10)
+
+
+def _packactions(actions):
+    # Binary encoding of a list of actions: their count, then each of them
+    data = bytearray(PACKED_COUNT.pack(len(actions)))
+    for action in actions:
+        data += PACKED_ACTION.pack(
+            ACTIONS.index(action[0]), int(action[1]), int(action[2]),
+            DIRS.index(action[3]) if len(action) > 3 else NODIR
+        )
+    return data
+
+
+def _unpackactions(data, offset):
+    # Actions encoded by _packactions at 'offset' in 'data', and the offset
+    # of what follows them
+    count = PACKED_COUNT.unpack_from(data, offset)[0]
+    offset += PACKED_COUNT.size
+    actions = []
+    for i in range(count):
+        action, x, y, d = PACKED_ACTION.unpack_from(data, offset)
+        if d == NODIR:
+            actions.append([ACTIONS[action], x, y])
+        else:
+            actions.append([ACTIONS[action], x, y, DIRS[d]])
+        offset += PACKED_ACTION.size
+    return actions, offset
+
+
+def _villagersmask(villagers):
+    # Bitmask of a collection of villagers' names (bit i for code VILLAGERCODE + i)
+    mask = 0
+    for villager in villagers:
+        mask |= 1 << (PIECECODES[villager] - VILLAGERCODE)
+    return mask
+
+
+def _initialstate(rnd):
+    '''Build the visible and hidden parts of the state of a new game.
+
+    Pre: 'rnd' is a random.Random instance
+    Post: The returned value is a pair (visible, hidden) of new dictionaries,
+          with the villagers placed and the deck of cards shuffled using
+          'rnd', and the assassins not chosen yet.
+    '''
+    villagers = rnd.sample(sorted(POPULATION), len(POPULATION))
+    return _setup(villagers, rnd.sample(CARDS, len(CARDS)))
+
+
+def _setup(villagers, cards):
+    # Visible and hidden parts of the state of a new game, the villagers
+    # being on the cells of sorted(VILLAGERS) in their order
+    people = [[None for column in range(10)] for row in range(10)]
+    people[9][9] = 'king'
+    for coord in KNIGHTS:
+        people[coord[0]][coord[1]] = 'knight'
+    for villager, coord in zip(villagers, sorted(VILLAGERS)):
+        people[coord[0]][coord[1]] = villager
+    return {
+        'board': BOARD,
+        'people': people,
+        'castle': CASTLE,
+        'card': None,
+        'king': 'healthy',
+        'lastopponentmove': [],
+        'arrested': [],
+        'killed': {
+            'knights': 0,
+            'assassins': 0
+        }
+    }, {
+        'assassins': None,
+        'cards': list(cards)
+    }
+
+
+def _newstate(rnd):
+    # State of a new game, see _initialstate
+    return KingAndAssassinsState(*_initialstate(rnd))
+
+
+def newgame(seed=None):
+    '''Build the state of a new game from a seed.
+
+    Pre: -
+    Post: The returned state shares nothing mutable with any other one. Its
+          villagers and its deck of cards are derived from 'seed' (from the
+          system's randomness if it is None), so that a game can be played
+          again from its seed.
+    '''
+    return _newstate(random.Random(seed))
+
+
+def _setassassins(state, move):
+    if 'assassins' not in move:
+        raise game.InvalidMoveException('The dictionary must contain an "assassins" key')
+    if not isinstance(move['assassins'], list):
+        raise game.InvalidMoveException('The value of the "assassins" key must be a list')
+    for assassin in move['assassins']:
+        if not isinstance(assassin, str):
+            raise game.InvalidMoveException('The "assassins" must be identified by their name')
+        if not assassin in POPULATION:
+            raise game.InvalidMoveException('Unknown villager: {}'.format(assassin))
+    state.setassassins(move['assassins'])
+    state.update([], 0)
+
+
+def _applymove(state, move, player):
+    # 'move' is the already decoded dictionary sent by a client
+    if state.isinitial():
+        _setassassins(state, move)
+    else:
+        state.update(move['actions'], player)
+        state.lastopponentmove = move['actions']
+
+
+def play_match(bot0, bot1, seed=None):
+    '''Play a whole game between two bots, in-process and without any socket.
+
+    The moves are exchanged as Python objects (no JSON) and the bots play on
+    copies of the visible state (no copy.deepcopy), following the same
+    rules as KingAndAssassinsServer: an invalid move is simply played again,
+    but a bot playing MAX_INVALID_MOVES invalid moves in a row loses by
+    forfeit.
+
+    Pre: 'bot0' and 'bot1' are KingAndAssassinsClient instances created
+         without a server (server=None).
+    Post: The returned value is a pair (winner, turns) where 'winner' is as
+          returned by KingAndAssassinsState.winner() and 'turns' is the number
+          of valid moves that have been played. If 'seed' is not None, the
+          villagers, the deck of cards and the bots' random choices are all
+          derived from it (see KingAndAssassinsClient.seed), without
+          touching the global random generator. The bots may be reused from
+          one match to the next: they forget the previous game first.
+    '''
+    state = newgame(seed)
+    bots = (bot0, bot1)
+    rnd = random.Random(seed)
+    for i in range(len(bots)):
+        bots[i]._newgame()
+        bots[i]._playernb = i
+        if seed is not None:
+            bots[i].seed(rnd.getrandbits(64))
+    player, turns, invalid = 0, 0, 0
+    winner = -1
+    while winner == -1:
+        move = bots[player]._choosemove(state.copy(hidden=False))
+        try:
+            _applymove(state, move, player)
+            turns += 1
+            invalid = 0
+            player = (player + 1) % len(bots)
+        except game.InvalidMoveException:
+            invalid += 1
+            if invalid == MAX_INVALID_MOVES:
+                return 1 - player, turns
+        winner = state.winner()
+    return winner, turns
+
+
+def _evaluate(state):
+    # Estimated chance of the assassins (player 0) to win an unfinished game:
+    # the further the king is from the castle for the action points he has
+    # left and the more he is injured, the better, the fewer assassins are
+    # left, the worse
+    distance = CASTLE_DISTANCES[state.kingpos]
+    if state.cards is None:
+        hurry = distance / 20
+    else:
+        remaining = state.kingap + sum(CARDS[card][0] for card in state.cards)
+        if distance > remaining:
+            # The king cannot reach the castle before the end of the deck
+            return 1.0
+        hurry = distance / (remaining + 1) / 2
+    caught = state.killedassassins
+    if state.assassins is not None:
+        caught += bin(state.arrested & state.assassins).count('1')
+    return max(0.0, min(1.0, 0.1 + hurry + state.king / 4 - caught / 10))
+
+
+def _kingdistances(state):
+    # Distances to the castle around the people (see topology.DistanceField),
+    # or the ones of the empty board if they wall the king in
+    distances = topology.DistanceField(TOPOLOGY, state.villagers | state.revealed).distances
+    return CASTLE_DISTANCES if distances[state.kingpos] == topology.UNREACHABLE else distances
+
+
+def _kingpath(state, distances):
+    # Cells of a shortest path of the king to the castle along 'distances'
+    # (reachable from his cell), avoiding the knights as much as possible
+    cell = state.kingpos
+    path = []
+    while distances[cell] > 0:
+        nexts = [
+            n for d, n in TOPOLOGY.neighbours[cell]
+            if distances[n] == distances[cell] - 1 and (n not in TOPOLOGY.castle or (cell, d) in TOPOLOGY.entries)
+        ]
+        cell = min(nexts, key=lambda n: state.cells[n] == KNIGHT)
+        path.append(cell)
+    return path
+
+
+def _policy(state, player, actions):
+    # Weights of the actions of a player for the search (see mcts.MCTS): the
+    # king walks towards the castle around the people, his knights step out
+    # of his way and capture the people around him, the assassins get close
+    # to him to attack him, revealing themselves when they are
+    kingpos = state.kingpos
+    kx, ky = divmod(kingpos, 10)
+    steps = TOPOLOGY.steps
+    if player == 1:
+        distances = _kingdistances(state)
+        distance = distances[kingpos]
+        path = set(_kingpath(state, distances))
+    weights = []
+    for action in actions:
+        kind = action[0]
+        if kind == 'end':
+            weight = 1.0
+        elif kind == 'attack':
+            weight = 100.0
+        elif kind == 'kill':
+            weight = 10.0
+        else:
+            cell = action[1] * 10 + action[2]
+            near = abs(action[1] - kx) + abs(action[2] - ky) <= 2
+            if kind == 'reveal':
+                weight = 20.0 if near else 0.05
+            elif kind == 'arrest':
+                weight = 6.0 if near else 2.0
+            elif cell == kingpos:
+                target = steps[action[3]][cell]
+                if target in TOPOLOGY.castle:
+                    weight = 1000.0
+                else:
+                    weight = 10.0 if distances[target] < distance else 0.1
+            else:
+                target = steps[action[3]][cell]
+                tx, ty = divmod(target, 10)
+                closer = abs(tx - kx) + abs(ty - ky) < abs(action[1] - kx) + abs(action[2] - ky)
+                if player == 1:
+                    # A knight steps out of the way of the king, not into it,
+                    # or escorts him
+                    if cell in path:
+                        weight = 1.0 if target in path else 5.0
+                    elif target in path:
+                        weight = 0.1
+                    else:
+                        weight = 2.0 if closer else 0.5
+                else:
+                    weight = (4.0 if state.cells[cell] == ASSASSIN else 2.0) if closer else 0.3
+        weights.append(weight)
+    return weights
+
+
+def _searchkey(state):
+    # Visible position of a state, whatever its card
+    return state._turnkey()[0]
+
+
+class Determinizer:
+    '''Class representing a sampler of the hidden information of the states.
+
+    A player sees the card of each of its turns, the deck is drawn among the
+    cards that have not been seen yet (see observe), in a random order. The
+    assassins are the ones chosen by player 0 ('assassins', a mask of
+    villagers), or drawn by player 1 according to its belief about them (a
+    belief.SubsetBelief over the villagers). Drawing a sample only costs a
+    copy of the visible state and two random draws, so that a search can
+    use a new one for each of its iterations.
+    '''
+    def __init__(self, player, assassins=None, belief=None):
+        self.player = player
+        self.assassins = assassins
+        self.belief = belief
+        # Cards that have not been seen yet, and the last observed turn
+        self.remaining = [CARDS.index(card) for card in CARDS]
+        self.__lastturn = None
+
+    def observe(self, state):
+        '''Observe a state in which the player has to play.
+
+        Pre: -
+        Post: The card of the turn is not in the remaining cards any more,
+              unless the same turn has already been observed (when a move
+              is played again after an invalid one).
+        '''
+        turn = (state.hashkey, state.lastopponentmove)
+        if state.card is not None and turn != self.__lastturn and state.card in self.remaining:
+            self.remaining.remove(state.card)
+        self.__lastturn = turn
+
+    def sample(self, state, rnd):
+        '''Draw a state with its hidden part.
+
+        Pre: 'rnd' is a random.Random instance.
+        Post: The returned value is a copy of the visible part of 'state',
+              with a deck of cards and assassins drawn as described above.
+        '''
+        world = state.copy(hidden=False)
+        world.cards = rnd.sample(self.remaining, len(self.remaining))
+        if self.player == 0:
+            world.assassins = self.assassins
+        else:
+            world.assassins = 0
+            for i in self.belief.sample(rnd):
+                world.assassins |= 1 << i
+        return world
+
+
+class GameRecord:
+    '''Class representing the record of a game.
+
+    A record holds what is needed to play the game again: the villagers in
+    the order of their cells (sorted(VILLAGERS)) and the deck of cards (as
+    indexes in CARDS), both drawn from 'seed', the assassins chosen by
+    player 0 and the list of the actions of each turn, along with the
+    thinking time of the player. Its binary encoding (see encode) is the
+    one written in game logs (see lib/gamelog.py).
+    '''
+    def __init__(self, seed, villagers, cards):
+        self.seed = seed
+        self.villagers = villagers
+        self.cards = cards
+        self.assassins = None
+        self.setuptime = 0.0
+        # Pairs (thinking time, actions) of the turns played after the
+        # choice of the assassins, player 1 playing first
+        self.turns = []
+        self.winner = -1
+
+    @classmethod
+    def fromstate(cls, state, seed):
+        '''Start the record of a game from its initial state.'''
+        villagers = [PIECES[state.cells[x * 10 + y]] for x, y in sorted(VILLAGERS)]
+        return cls(seed, villagers, list(state.cards))
+
+    def encode(self):
+        data = bytearray(RECORD_HEADER.pack(
+            RECORD_VERSION,
+            self.seed & 0xFFFFFFFFFFFFFFFF,
+            NOWINNER if self.winner is None or self.winner == -1 else self.winner,
+            _villagersmask(self.assassins or []),
+            bytes(PIECECODES[villager] - VILLAGERCODE for villager in self.villagers),
+            bytes(self.cards),
+            _microseconds(self.setuptime),
+            len(self.turns)
+        ))
+        for seconds, actions in self.turns:
+            data += RECORD_TURN.pack(_microseconds(seconds))
+            data += _packactions(actions)
+        return bytes(data)
+
+    @classmethod
+    def decode(cls, data):
+        '''Build a record from its binary encoding, as returned by encode.'''
+        version, seed, winner, assassins, villagers, cards, setuptime, turns = RECORD_HEADER.unpack_from(data)
+        if version != RECORD_VERSION:
+            raise ValueError('unknown version of game record: {}'.format(version))
+        record = cls(seed, [PIECES[VILLAGERCODE + i] for i in villagers], list(cards))
+        record.winner = -1 if winner == NOWINNER else winner
+        record.assassins = [PIECES[VILLAGERCODE + i] for i in range(len(POPULATION)) if assassins >> i & 1]
+        record.setuptime = setuptime / 1e6
+        offset = RECORD_HEADER.size
+        for turn in range(turns):
+            seconds = RECORD_TURN.unpack_from(data, offset)[0] / 1e6
+            actions, offset = _unpackactions(data, offset + RECORD_TURN.size)
+            record.turns.append((seconds, actions))
+        return record
+
+    def state(self, turn=None):
+        '''Rebuild the state of the game after some turns.
+
+        Pre: 0 <= turn <= len(self.turns) + 1, or turn is None.
+        Post: The returned value is the state of the server (hidden part
+              included) after the first 'turn' valid moves, the choice of the
+              assassins being the first one, or at the end of the game if
+              'turn' is None.
+        '''
+        state = KingAndAssassinsState(*_setup(self.villagers, [CARDS[card] for card in self.cards]))
+        moves = [{'assassins': self.assassins}] + [{'actions': actions} for seconds, actions in self.turns]
+        for i, move in enumerate(moves[:turn]):
+            _applymove(state, move, i % 2)
+        return state
+
+
+def _microseconds(seconds):
+    # Thinking time in a record, saturated if it does not fit
+    return min(int(seconds * 1e6), 0xFFFFFFFF)
+
+
 class KingAndAssassinsServer(game.GameServer):
     '''Class representing a server for the King & Assassins game'''
 
-    def __init__(self, verbose=False):
-        super().__init__('King & Assassins', 2, KingAndAssassinsState(), verbose=verbose)
-        self._state._state['hidden'] = {
-            'assassins': None,
-            'cards': random.sample(CARDS, len(CARDS))
-        }
+    def __init__(self, verbose=False, metrics=None, seed=None, movetime=None, gametime=None, games=1,
+                 record=None):
+        self.__seed = seed
+        # Log the records of the games are appended to (a GameLogWriter),
+        # and the record of the running game
+        self.__log = record
+        self.__record = None
+        super().__init__('King & Assassins', 2, None, verbose=verbose, metrics=metrics,
+                         movetime=movetime, gametime=gametime, games=games)
+        self.reset(0)
 
-    def _setassassins(self, move):
-        state = self._state
-        if 'assassins' not in move:
-            raise game.InvalidMoveException('The dictionary must contain an "assassins" key')
-        if not isinstance(move['assassins'], list):
-            raise game.InvalidMoveException('The value of the "assassins" key must be a list')
-        for assassin in move['assassins']:
-            if not isinstance(assassin, str):
-                raise game.InvalidMoveException('The "assassins" must be identified by their name')
-            if not assassin in POPULATION:
-                raise game.InvalidMoveException('Unknown villager: {}'.format(assassin))
-        state.setassassins(move['assassins'])
-        state.update([], 0)
+    def reset(self, game):
+        # The games of a seeded series are seeded too, the other ones get a
+        # seed of their own so that they can be played again
+        seed = random.getrandbits(63) if self.__seed is None else self.__seed + game
+        self._state = newgame(seed)
+        if self.__log is not None:
+            self.__record = GameRecord.fromstate(self._state, seed)
+
+    def moveplayed(self, move, seconds):
+        # The move has just been decoded by applymove
+        if self.__record is None:
+            return
+        move = self.__move
+        if self.__record.assassins is None:
+            self.__record.assassins = list(move['assassins'])
+            self.__record.setuptime = seconds
+        else:
+            self.__record.turns.append((seconds, move['actions']))
+
+    def gameended(self, winner):
+        if self.__record is not None:
+            self.__record.winner = winner
+            self.__log.append(self.__record.encode())
+
+    def defaultmove(self):
+        # A late player passes its turn, but there is no default choice of
+        # the assassins
+        if self._state.isinitial():
+            return None
+        return '{"actions":[]}'
 
     def applymove(self, move):
         try:
-            state = self._state
             move = json.loads(move)
-            if state.isinitial():
-                self._setassassins(move)
-            else:
-                self._state.update(move['actions'], self.currentplayer)
+            self.metrics.lap('parse')
+            _applymove(self._state, move, self.currentplayer)
+            self.__move = move
         except game.InvalidMoveException as e:
             raise e
         except Exception as e:
@@ -285,15 +1243,43 @@ class KingAndAssassinsServer(game.GameServer):
 class KingAndAssassinsClient(game.GameClient):
     '''Class representing a client for the King & Assassins game'''
 
-    def __init__(self, name, server, verbose=False):
-        super().__init__(server, KingAndAssassinsState, verbose=verbose)
+    def __init__(self, name, server, verbose=False, delta=False, codec='json', metrics=None, series=False):
         self.__name = name
+        options = {}
+        if delta:
+            options['delta'] = True
+        if codec != 'json':
+            options['codec'] = codec
+        if series:
+            options['series'] = True
+        # Distances of the king to the castle, kept from one turn to the next
+        self.__field = None
+        # Belief of the king's team about the assassins, and the cells on
+        # which the villagers were last seen
+        self._belief = None
+        self._lastseen = {}
+        # Source of the random choices of the bot
+        self._rnd = random.Random()
+        super().__init__(server, KingAndAssassinsState, verbose=verbose, name=name, options=options,
+                         metrics=metrics)
         self.laststate= []
 
     def _handle(self, message):
         pass
 
+    def seed(self, seed):
+        '''Seed the random choices of this bot.'''
+        self._rnd.seed(seed)
+
+    def _newgame(self):
+        self.__field = None
+        self._belief = None
+        self._lastseen = {}
+
     def _nextmove(self, state):
+        return json.dumps(self._choosemove(state), separators=(',', ':'))
+
+    def _choosemove(self, state):
         # Two possible situations:
         # - If the player is the first to play, it has to select his/her assassins
         #   The move is a dictionary with a key 'assassins' whose value is a list of villagers' names
@@ -304,203 +1290,389 @@ class KingAndAssassinsClient(game.GameClient):
         #   ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
         #   ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
         #   ('reveal', x, y): reveals villager at position (x,y) as an assassin
-        state = state._state['visible']
-        if state['card'] is None:
-            poplist= list(POPULATION)
+        # The returned move is a Python dictionary, _nextmove encodes it
+        state = state.copy(hidden=False)
+        if state.card is None:
+            poplist= sorted(POPULATION)
             self._KRIM= [poplist[0], poplist[1], poplist[2]]
-            return json.dumps({'assassins': self._KRIM}, separators=(',', ':'))
+            return {'assassins': self._KRIM}
         else:
             if self._playernb == 0:
-                for i in range(10):
-                    for j in range(10):
-                        if state['people'][i][j] in set(self._KRIM):
-                            return json.dumps({'actions': [('reveal', i, j)]}, separators=(',', ':'))
-                return json.dumps({'actions': self._guessassassins(state)}, separators=(',', ':'))
+                for cell in sorted(state.villagers):
+                    if PIECES[state.cells[cell]] in set(self._KRIM):
+                        return {'actions': [('reveal', cell // 10, cell % 10)]}
+                return {'actions': self._guessassassins(state)}
             else:
-                return json.dumps({'actions': self._guessking(state)}, separators=(',', ':'))
+                self._observe(state)
+                return {'actions': self._guessking(state)}
 
-    def _getP1coords(self, state):
-        knightcoords= []
-        for i in range(10):
-            for j in range(10):
-                if state['people'][i][j]=='king':
-                    king= (i, j)
-                elif state['people'][i][j]== 'knight':
-                    knightcoords += [(i, j)]
-        return (king, knightcoords)
-
-    def _verdir(self, state, coord):
-        try:
-            #print('NORD', state['people'][coord[0]-1][coord[1]])
-            verN= None==state['people'][coord[0]-1][coord[1]]
-        except:
-            verN= False
-        try:
-            #print('EST', state['people'][coord[0]][coord[1]+1])
-            verE= None==state['people'][coord[0]][coord[1]+1]
-        except:
-            verE= False
-        try:
-            #print('SUD', state['people'][coord[0]+1][coord[1]])
-            verS= None==state['people'][coord[0]+1][coord[1]]
-        except:
-            verS= False
-        try:
-            #print('OUEST', state['people'][coord[0]][coord[1]-1])
-            verW= None==state['people'][coord[0]][coord[1]-1]
-        except:
-            verW= False
-        #print(verN, verE, verS, verW)
-        return verN, verE, verS, verW
-
-    def _checkground(self, coord):
-        try:
-            if BOARD[coord[0]][coord[1]]== 'G':
-                return True
-            else:
-                return False
-        except:
-            return False
+    def _observe(self, state):
+        # Update the belief about the assassins with the villagers seen on
+        # the board: the ones who disappeared without being arrested have
+        # been revealed, and the ones who moved towards the king are more
+        # suspicious (and less if they moved away from him)
+        if self._belief is None:
+            self._belief = belief.SubsetBelief(len(POPULATION), NBASSASSINS)
+        seen = {state.cells[cell] - VILLAGERCODE: cell for cell in state.villagers}
+        kx, ky = divmod(state.kingpos, 10)
+        for i, cell in self._lastseen.items():
+            if i not in seen:
+                if not state.arrested >> i & 1:
+                    self._belief.include(i)
+            elif seen[i] != cell:
+                before = abs(cell // 10 - kx) + abs(cell % 10 - ky)
+                after = abs(seen[i] // 10 - kx) + abs(seen[i] % 10 - ky)
+                if after != before:
+                    self._belief.scale(i, SUSPICION if after < before else 1 / SUSPICION)
+        self._lastseen = seen
 
-                
     def _guessking(self, state):
-        j=0
-        running= True
-        card= state['card']
-        movelist= []
-        king, knights= self._getP1coords(state)
-        target= state['castle'][0]
-        posdir= []
-        while running:
-            if card[0] != 0:
-                N, E, S, W = self._verdir(state, king)
-                dirs= [N, E, S, W, 'N', 'E', 'S', 'W']
-                if N or E or S or W:
-                    i=0
-                    while i < 4:
-                        if dirs[i]:
-                            nx, ny= KingAndAssassinsState._getcoord(self, (king[0], king[1], dirs[i+4]))
-                            Db= hypot(target[0]-king[0], target[1]-king[1])
-                            Da= hypot(target[0]-nx, target[1]-ny)
-                            if Da < Db and self._checkground((nx, ny)) and card[0]!=0 and state['people'][nx][ny]==None:
-                                card[0]-=1
-                                movelist += [('move', king[0], king[1], dirs[i+4])]
-                                state['people'][nx][ny]= 'king'
-                                state['people'][king[0]][king[1]]= None
-                                #print('1st: King from', king, 'to', (nx, ny), card[0], 'moves left')
-                                king= (nx, ny)
-                                N, E, S, W= self._verdir(state, king)
-                        i+=1
-                    if card[1]== 0:
-                        i=0
-                        while i < 4:
-                            if dirs[i]:
-                                posdir += [dirs[i+4]]
-                            i+=1
-                        try:
-                            direction= random.choice(posdir)
-                        except:
-                            running= False
-                        nx, ny= KingAndAssassinsState._getcoord(self, (king[0], king[1], direction))
-                        if self._checkground((nx, ny)) and card[0]!=0:
-                            card[0]-=1
-                            movelist += [('move', king[0], king[1], direction)]
-                            state['people'][nx][ny]= 'king'
-                            state['people'][king[0]][king[1]]= None
-                            #print('2nd: King from', king, 'to', (nx, ny), card[0], 'moves left')
-                            king, knights= self._getP1coords(state)
-                        else:
-                            if j>25:
-                                card[0]-=1
-
-                if j>25:
-                    #print('J > 25', movelist)
-                    running= False
-                    if len(movelist)==0:
-                        return []
-                    else:
-                        return movelist
-            if card[1] != 0:
-                l= len(knights)
-                try:
-                    o= random.randint(0, l-1)
-                except:
-                    o=0
-                p= ['N', 'E', 'S', 'W']
-                a, b, c, d = self._verdir(state, knights[o])
-                i=0
-                dirg= []
-                ver= False
-                for elm in [a, b, c, d]:
-                    if elm:
-                        ver= True
-                        dirg+= [p[i]]
-                    i+=1
-                if ver:
-                    dirc= random.choice(dirg)
-                    nxx, nyy= KingAndAssassinsState._getcoord(self, (knights[o][0], knights[o][1], dirc))
-                if ver and self._checkground((nxx, nyy)):
-                    card[1]-=1
-                    movelist += [('move', knights[o][0], knights[o][1], dirc)]
-                    #print(knights[o][0], knights[o][1], dirc)
-                    #print('Knight from', knights[o], 'to', (nxx, nyy), card[1], 'moves left')
-                    state['people'][nxx][nyy]= 'knight'
-                    state['people'][knights[o][0]][knights[o][1]]= None
-                    king, knights= self._getP1coords(state)
-                    dirc = None
-                    dirg = []
-            if card[0]==0 and card[1]==0:
-                running= False
-                return movelist
-            j+=1
+        # The turn is planned by a search bounded by the action points: as
+        # long as a sequence of one or two actions brings the king closer to
+        # the castle (moving along a shortest path, knights stepping out of
+        # it or arresting the villagers standing in the way), the best one is
+        # played. The knights then use their remaining action points to kill
+        # the revealed assassins and to arrest the villagers, the most
+        # suspicious ones first (and then the closest to the king).
+        field = self._kingfield(state)
+        movelist = []
+        depth = 1
+        while depth <= 2:
+            cost, actions = self._kingsearch(state, field, self._kingroute(state, field), depth)
+            if len(actions) == 0:
+                depth += 1
+                continue
+            for action in actions:
+                self._kingaction(state, field, action)
+            movelist += actions
+            depth = 1
+        kx, ky = divmod(state.kingpos, 10)
+        while True:
+            captures = [action for action in state.legal_actions(1) if action[0] in ('kill', 'arrest')]
+            if len(captures) == 0:
+                break
+            targets = [_step(action[1:]) for action in captures]
+            i = min(range(len(captures)), key=lambda i: (
+                captures[i][0] != 'kill',
+                -self._suspicion(state, targets[i]),
+                abs(targets[i][0] - kx) + abs(targets[i][1] - ky)
+            ))
+            self._kingaction(state, field, captures[i])
+            movelist.append(captures[i])
+        return movelist
 
-    def _GetPopList(self, state):
-        poplist= []
-        for i in range(10):
-            for j in range(10):
-                if state['people'][i][j] in POPULATION:
-                    poplist += [(i, j)]
-        return poplist
+    def _kingsearch(self, state, field, route, depth):
+        # Sequence of at most 'depth' actions of the king or of the knights
+        # on or next to his path (see _kingroute) leading to the lowest cost,
+        # the steps of the king to the castle around the people plus the
+        # knights on his path, as a pair (cost, actions). Only the arrests
+        # and the kills change the distance field, and the path is followed
+        # as long as the king steps along it
+        path, near, knights = route
+        kingpos = state.kingpos
+        best = (field.distances[kingpos] + knights, [])
+        if depth == 0:
+            return best
+        for action in state.legal_actions(1):
+            cell = action[1] * 10 + action[2]
+            if cell != kingpos and cell not in near:
+                continue
+            if action[0] == 'move':
+                target = TOPOLOGY.steps[action[3]][cell]
+                record = state.apply(action, 1)
+                if cell != kingpos:
+                    nextroute = (path, near, knights - (cell in path) + (target in path))
+                elif target in path:
+                    nextroute = route
+                else:
+                    nextroute = self._kingroute(state, field)
+                cost, actions = self._kingsearch(state, field, nextroute, depth - 1)
+                state.undo(record)
+            else:
+                snapshot = field.save()
+                record = self._kingaction(state, field, action)
+                cost, actions = self._kingsearch(state, field, self._kingroute(state, field), depth - 1)
+                state.undo(record)
+                field.restore(snapshot)
+            if cost < best[0]:
+                best = (cost, [action] + actions)
+        return best
+
+    def _suspicion(self, state, coord):
+        # Probability that the villager at 'coord' is an assassin
+        code = state.cells[coord[0] * 10 + coord[1]]
+        if self._belief is None or code < VILLAGERCODE:
+            return 0.0
+        return self._belief.probability(code - VILLAGERCODE)
+
+    def _kingfield(self, state):
+        # Distances to the castle around the people (the knights can step
+        # aside), kept from the last turn and brought up to date with the
+        # moves of the villagers since then, or rebuilt if it does not match
+        # the state (at the first turn, or if our last move was rejected)
+        field = self.__field
+        if field is not None:
+            for action in state.lastopponentmove:
+                if action[0] == 'move':
+                    cell, target = _cells(action)
+                    field.free(cell)
+                    field.block(target)
+        people = state.villagers | state.revealed
+        if field is None or any(field.blocked[cell] != (cell in people) for cell in range(100)):
+            field = topology.DistanceField(TOPOLOGY, people)
+        self.__field = field
+        return field
+
+    def _kingroute(self, state, field):
+        # Shortest path of the king to the castle around the people (see
+        # _kingpath) as a triple: the cells of the path, the cells on or next
+        # to it and the number of knights on it to move out of the way (an
+        # empty path if the people wall the king in, any knight being near
+        # it then, to arrest them)
+        if field.distances[state.kingpos] == topology.UNREACHABLE:
+            return frozenset(), frozenset(range(100)), 0
+        path = frozenset(_kingpath(state, field.distances))
+        near = path.union(*(NEIGHBOURS[cell] for cell in path))
+        return path, near, sum(state.cells[cell] == KNIGHT for cell in path)
+
+    def _kingaction(self, state, field, action):
+        # Apply an action of the king's team, the arrested and killed people
+        # freeing their cells in the distance field
+        record = state.apply(action, 1)
+        if action[0] != 'move':
+            field.free(_cells(action)[1])
+        return record
 
     def _guessassassins(self, state):
-        AP= state['card'][3]
-        poplist= []
-        movelist=[]
-        poplist= self._GetPopList(state)
-        p= ['N', 'E', 'S', 'W']
-        while AP != 0:
-            rd= random.randint(0, len(poplist)-1)
-            x, y= poplist[rd]
-            a, b, c, d= self._verdir(state, (x, y))
-            if a or b or c or d:
-                i=0
-                truelm= []
-                for elem in [a, b, c, d]:
-                    if elem:
-                        truelm += [p[i]]
-                    i+=1
-                choice = random.choice(truelm)
-                nx, ny= KingAndAssassinsState._getcoord(self, (x, y, choice))
-                if self._checkground((nx, ny)):
-                    AP-=1
-                    #print(x, y, choice)
-                    movelist += [('move', x, y, choice)]
-                    #print('commoner went from ({},{}) to ({},{})'.format(x,y,nx,ny))
-                    state['people'][nx][ny]= state['people'][x][y]
-                    state['people'][x][y]= None
-                    poplist= self._GetPopList(state)
-            else:
-                rd= random.randint(0, len(poplist)-1)
-                x, y= poplist[rd]
-                p= ['N', 'E', 'S', 'W']
-                a, b, c, d= self._verdir(self, poplist[rd])
-        return movelist
+        # The turn is built from the legal actions: villagers still hidden in
+        # the crowd step at random onto the ground, as long as the people
+        # have action points left and one of them can
+        movelist = []
+        while True:
+            moves = [
+                action for action in state.legal_actions(0)
+                if action[0] == 'move' and state.cells[_cells(action)[0]] != ASSASSIN
+                and TOPOLOGY.ground[_cells(action)[1]]
+            ]
+            if len(moves) == 0:
+                return movelist
+            action = self._rnd.choice(moves)
+            state.apply(action, 0)
+            movelist.append(action)
+
+
+class KingAndAssassinsMCTSClient(KingAndAssassinsClient):
+    '''Class representing a client playing with a Monte Carlo Tree Search
+
+    The search is played on determinizations of the state, each iteration on
+    its own (see Determinizer): the deck is drawn among the cards that have
+    not been seen yet, and the assassins are the chosen ones for player 0
+    and are drawn according to the belief about them for player 1 (see
+    KingAndAssassinsClient._observe). The tree is reused from one turn to the
+    next one, and the positions reached by different orders of actions are
+    shared through a transposition table of at most 'tablemb' megabytes (in
+    each process).
+    '''
+
+    def __init__(self, name, server, verbose=False, delta=False, codec='json', thinkms=200, workers=0,
+                 tablemb=64, metrics=None, series=False):
+        self.__thinkms = thinkms
+        self.__verbose = verbose
+        self.__tablemb = tablemb
+        self.__search = mcts.MCTS(END, evaluate=_evaluate, key=_searchkey, policy=_policy, widening=WIDENING,
+                                  table=transposition.TranspositionTable(tablemb << 20, mcts.TABLE_ENTRY_SIZE))
+        self.__determinizer = None
+        # Root parallelization: every worker process grows its own tree for
+        # each turn, along with the one of this process
+        self.__pool = None
+        if workers > 0:
+            self.__pool = concurrent.futures.ProcessPoolExecutor(workers)
+            list(self.__pool.map(_mctswarmup, range(workers)))
+        self.__workers = workers
+        super().__init__(name, server, verbose=verbose, delta=delta, codec=codec, metrics=metrics, series=series)
+        if server is not None:
+            self.close()
+
+    def seed(self, seed):
+        super().seed(seed)
+        self.__search.rnd.seed(self._rnd.getrandbits(64))
+
+    def _newgame(self):
+        # The transposition table stays warm from one game to the next
+        super()._newgame()
+        self.__determinizer = None
+        self.__search.newgame()
+
+    def close(self):
+        '''Stop the worker processes of the search, if any.'''
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+    def _choosemove(self, state):
+        if state.card is None:
+            # The assassins are the villagers the closest to the king
+            kx, ky = divmod(state.kingpos, 10)
+            cells = sorted(state.villagers, key=lambda cell: (abs(cell // 10 - kx) + abs(cell % 10 - ky), cell))
+            assassins = [PIECES[state.cells[cell]] for cell in cells[:NBASSASSINS]]
+            self.__determinizer = Determinizer(0, assassins=_villagersmask(assassins))
+            return {'assassins': assassins}
+        player = self._playernb
+        if player == 1:
+            self._observe(state)
+            if self.__determinizer is None:
+                self.__determinizer = Determinizer(1, belief=self._belief)
+        determinizer = self.__determinizer
+        determinizer.observe(state)
+        start = time.perf_counter()
+        self.__search.advance([tuple(action) for action in state.lastopponentmove] + [END])
+        futures = []
+        if self.__pool is not None:
+            futures = [
+                self.__pool.submit(_mctsworker, state, player, self.__thinkms, determinizer,
+                                   self.__tablemb, self._rnd.getrandbits(32))
+                for i in range(self.__workers)
+            ]
+        turn = self.__search.search(state, player, self.__thinkms, determinizer.sample)
+        playouts = self.__search.iterations
+        if len(futures) > 0:
+            stats = [self.__search.turnstats(player)]
+            for future in futures:
+                workerstats, iterations = future.result()
+                stats.append(workerstats)
+                playouts += iterations
+            turn = mcts.bestturn(state, player, mcts.merge(stats), END)
+        self.__search.advance(turn + [END])
+        if self.__verbose:
+            elapsed = time.perf_counter() - start
+            print('   Search: {} playouts in {:.0f} ms ({:.0f} playouts/s)'.format(
+                playouts, elapsed * 1000, playouts / elapsed))
+        return {'actions': turn}
+
+
+def _mctsworker(state, player, thinkms, determinizer, tablemb, seed):
+    # Search of a worker process, the returned value is a pair (turn
+    # statistics, number of iterations)
+    search = mcts.MCTS(END, evaluate=_evaluate, key=_searchkey, policy=_policy, widening=WIDENING,
+                       rnd=random.Random(seed),
+                       table=transposition.TranspositionTable(tablemb << 20, mcts.TABLE_ENTRY_SIZE))
+    search.search(state, player, thinkms, determinizer.sample)
+    return search.turnstats(player), search.iterations
+
+
+def _mctswarmup(i):
+    # Run a tiny search, so that the worker process is started and ready
+    state = _newstate(random.Random(i))
+    state.setassassins(sorted(POPULATION)[:NBASSASSINS])
+    state.update([], 0)
+    mcts.MCTS(END, evaluate=_evaluate, policy=_policy, widening=WIDENING).search(state, 1, iterations=10)
+
+
+# Clients selectable with the --bot option of the 'client' subcommand
+BOTS = {
+    'heuristic': KingAndAssassinsClient,
+    'mcts': KingAndAssassinsMCTSClient
+}
+
+
+def _botoptions(bot, thinkms=200, workers=0, tablemb=64):
+    # Options of the client class of a bot, the heuristic one has none
+    if bot == 'heuristic':
+        return {}
+    return {'thinkms': thinkms, 'workers': workers, 'tablemb': tablemb}
+
+
+def _tournamentgame(number, bots, seed, thinkms):
+    # Play one game of a tournament, the returned value is its record
+    start = time.perf_counter()
+    players = [BOTS[bot]('{} {}'.format(bot, seat), None, **_botoptions(bot, thinkms)) for seat, bot in enumerate(bots)]
+    winner, turns = play_match(players[0], players[1], seed)
+    return {
+        'game': number,
+        'seed': seed,
+        'players': list(bots),
+        'winner': winner,
+        'turns': turns,
+        'seconds': round(time.perf_counter() - start, 4)
+    }
+
+
+def checkrematches(bots, games, seed=0, thinkms=10):
+    '''Check that bots reused from one match to the next play new games.
+
+    Each pair of bots (or the bot against itself, if there is only one)
+    plays 'games' matches with the same two instances, with the seeds
+    seed, seed+1, ..., the first bot of the pair playing the assassins.
+
+    Pre: 'bots' are names of BOTS.
+    Post: The returned value is the number of matches that have been played.
+    Raises AssertionError: If a match of bots without a thinking time does
+           not end as with new instances of them.
+    '''
+    pairs = list(itertools.combinations(bots, 2)) if len(bots) > 1 else [(bots[0], bots[0])]
+    played = 0
+    for pair in pairs:
+        players = [
+            BOTS[bot]('{} {}'.format(bot, seat), None, **_botoptions(bot, thinkms)) for seat, bot in enumerate(pair)
+        ]
+        for i in range(games):
+            result = play_match(players[0], players[1], seed + i)
+            if all(len(_botoptions(bot)) == 0 for bot in pair):
+                new = [BOTS[bot]('{} {}'.format(bot, seat), None) for seat, bot in enumerate(pair)]
+                assert result == play_match(new[0], new[1], seed + i), 'match {} differs'.format(i)
+            played += 1
+    return played
+
+
+def play_tournament(bots, games, seed=0, workers=None, output=None, thinkms=200):
+    '''Play a tournament between bots, on a pool of worker processes.
+
+    Each pair of bots (or the bot against itself, if there is only one)
+    plays 'games' games. The seats alternate: the games 2i and 2i+1 are
+    played with the seed seed+i and the bots in the other seats.
+
+    Pre: 'bots' are names of BOTS.
+    Post: The returned value is a pair (standings, seconds) with the
+          tournament.Standings of the games and the time they took. The
+          record of each game has been written as a JSON line to the
+          'output' file object (if not None) as soon as it ended.
+    '''
+    pairs = list(itertools.combinations(bots, 2)) if len(bots) > 1 else [(bots[0], bots[0])]
+    schedule = []
+    for pair in pairs:
+        for i in range(games):
+            schedule.append((len(schedule), pair if i % 2 == 0 else pair[::-1], seed + i // 2, thinkms))
+    standings = tournament.Standings()
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_tournamentgame, *game) for game in schedule]
+        for future in concurrent.futures.as_completed(futures):
+            record = future.result()
+            standings.add(record['players'], record['winner'], record['turns'])
+            if output is not None:
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+    return standings, time.perf_counter() - start
+
+
+def _printstandings(standings, seconds):
+    print('{} games in {:.1f} s ({:.2f} games/s), {:.1f} turns per game'.format(
+        standings.games, seconds, standings.games / seconds, standings.turns / max(1, standings.games)))
+    for result in standings.report():
+        print()
+        print(' {} vs {}'.format(*result['players']))
+        print('   Games: {}, wins: {} - {}, wins by seat: {} - {}'.format(
+            result['games'], result['wins'][0], result['wins'][1], *result['seatwins']))
+        print('   Win rate of {}: {:.1%} (95% CI {:.1%} - {:.1%})'.format(
+            result['players'][0], result['winrate'], *result['interval']))
+        print('   Elo difference: {:+.0f} (95% CI {:+.0f} - {:+.0f})'.format(result['elo'], *result['elointerval']))
+        print('   Turns per game: {:.1f}'.format(result['turns']))
 
 if __name__ == '__main__':
     # Create the top-level parser
     parser = argparse.ArgumentParser(description='King & Assassins game')
     subparsers = parser.add_subparsers(
-        description='server client',
+        description='server client replay tournament',
         help='King & Assassins game components',
         dest='component'
     )
@@ -509,19 +1681,120 @@ if __name__ == '__main__':
     server_parser = subparsers.add_parser('server', help='launch a server')
     server_parser.add_argument('--host', help='hostname (default: localhost)', default='localhost')
     server_parser.add_argument('--port', help='port to listen on (default: 5000)', default=5000)
+    server_parser.add_argument('--multi', action='store_true',
+                               help='host many concurrent games on the port, pairing clients as they connect')
+    server_parser.add_argument('--metrics', metavar='FILE',
+                               help='write the timings of the turns to FILE at the end of the game, in the '
+                                    'Prometheus text format if it ends with .prom, as JSON otherwise '
+                                    '(not with --multi)')
+    server_parser.add_argument('--move-time', type=float, metavar='SECONDS',
+                               help='time a player has for each move, it passes its turn when it is late '
+                                    '(default: no limit)')
+    server_parser.add_argument('--game-time', type=float, metavar='SECONDS',
+                               help='time a player has for all its moves, it loses when it is spent '
+                                    '(default: no limit)')
+    server_parser.add_argument('--games', type=int, default=1,
+                               help='number of games of the series played over the same connections with the '
+                                    'clients started with --series, the players swapping seats (default: 1)')
+    server_parser.add_argument('--record', metavar='FILE',
+                               help='append the record of each game to the game log FILE (see the replay '
+                                    'subcommand)')
+    server_parser.add_argument('--seed', type=int,
+                               help='seed of the placement of the villagers and of the deck of cards, to play '
+                                    'a game again (not with --multi)')
     server_parser.add_argument('-v', '--verbose', action='store_true')
     # Create the parser for the 'client' subcommand
     client_parser = subparsers.add_parser('client', help='launch a client')
     client_parser.add_argument('name', help='name of the player')
-    client_parser.add_argument('--host', help='hostname of the server (default: localhost)',
-                               default=socket.gethostbyname(socket.gethostname()))
+    client_parser.add_argument('--host', help='hostname of the server (default: the address of this machine)')
     client_parser.add_argument('--port', help='port of the server (default: 5000)', default=5000)
+    client_parser.add_argument('--delta', action='store_true',
+                               help='only receive the changes of the state after the first turn')
+    client_parser.add_argument('--codec', choices=('json', 'binary'), default='json',
+                               help='encoding of the full states sent by the server (default: json)')
+    client_parser.add_argument('--bot', choices=sorted(BOTS), default='heuristic',
+                               help='player to use (default: heuristic)')
+    client_parser.add_argument('--think-ms', type=int, default=200,
+                               help='thinking time of the search-based players, in milliseconds (default: 200)')
+    client_parser.add_argument('--workers', type=int, default=0,
+                               help='number of worker processes of the search-based players (default: 0)')
+    client_parser.add_argument('--table-mb', type=int, default=64,
+                               help='memory cap of the transposition table of the search-based players, '
+                                    'in megabytes (default: 64)')
+    client_parser.add_argument('--series', action='store_true',
+                               help='stay connected to play all the games of a series (see server --games)')
+    client_parser.add_argument('--metrics', metavar='FILE',
+                               help='write the timings of the turns to FILE at the end of the game, in the '
+                                    'Prometheus text format if it ends with .prom, as JSON otherwise')
     client_parser.add_argument('-v', '--verbose', action='store_true')
+    # Create the parser for the 'replay' subcommand
+    replay_parser = subparsers.add_parser('replay', help='show a recorded game')
+    replay_parser.add_argument('log', help='game log written by the server with --record')
+    replay_parser.add_argument('--game', type=int, default=-1, help='number of the game (default: the last one)')
+    replay_parser.add_argument('--turn', type=int,
+                               help='number of moves played, the choice of the assassins included '
+                                    '(default: the end of the game)')
+    # Create the parser for the 'tournament' subcommand
+    tournament_parser = subparsers.add_parser('tournament', help='play games between bots')
+    tournament_parser.add_argument('bots', nargs='+', choices=sorted(BOTS),
+                                   help='bots playing against each other (or against itself, if there is only one)')
+    tournament_parser.add_argument('--games', type=int, default=100,
+                                   help='number of games of each pair of bots (default: 100)')
+    tournament_parser.add_argument('--seed', type=int, default=0, help='seed of the first games (default: 0)')
+    tournament_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                                   help='number of worker processes (default: number of CPUs)')
+    tournament_parser.add_argument('--output', help='JSON lines file receiving the record of each game')
+    tournament_parser.add_argument('--think-ms', type=int, default=200,
+                                   help='thinking time of the search-based players, in milliseconds (default: 200)')
+    tournament_parser.add_argument('--check', action='store_true',
+                                   help='instead of the tournament, play its games in this process with the same '
+                                        'instances of the bots, checking that they forget their previous games')
     # Parse the arguments of sys.args
     args = parser.parse_args()
 
     if args.component == 'server':
-        KingAndAssassinsServer(verbose=args.verbose).run()
+        log = None if args.record is None else gamelog.GameLogWriter(args.record)
+        if args.multi:
+            if args.metrics is not None or args.seed is not None or args.games != 1:
+                server_parser.error('--metrics, --seed and --games are not supported with --multi')
+            game.MatchServer(lambda: KingAndAssassinsServer(verbose=args.verbose, movetime=args.move_time,
+                                                            gametime=args.game_time, record=log),
+                             2, args.host, args.port, verbose=args.verbose).run()
+        else:
+            recorder = None if args.metrics is None else metrics.Metrics('kingandassassins_server')
+            KingAndAssassinsServer(verbose=args.verbose, metrics=recorder, seed=args.seed, movetime=args.move_time,
+                                   gametime=args.game_time, games=args.games, record=log).run()
+            if recorder is not None:
+                recorder.export(args.metrics)
+        if log is not None:
+            log.close()
+    elif args.component == 'replay':
+        with gamelog.GameLogReader(args.log) as log:
+            record = GameRecord.decode(log[args.game])
+            print('Game {} of {}: seed {}, winner {}, {} moves'.format(
+                args.game % len(log), len(log), record.seed, record.winner, len(record.turns) + 1))
+            print('Assassins: {} (chosen in {:.3f} s)'.format(', '.join(record.assassins), record.setuptime))
+            for turn, (seconds, actions) in enumerate(record.turns[:None if args.turn is None else max(0, args.turn - 1)]):
+                print(' {:>3}. player {} ({:.3f} s): {}'.format(turn + 2, (turn + 1) % 2, seconds, actions))
+            record.state(args.turn).prettyprint()
+    elif args.component == 'tournament':
+        if args.check:
+            print('{} matches played with reused bots'.format(
+                checkrematches(args.bots, args.games, args.seed, args.think_ms)))
+            sys.exit()
+        output = None if args.output is None else open(args.output, 'w')
+        try:
+            _printstandings(*play_tournament(args.bots, args.games, args.seed, args.workers, output, args.think_ms))
+        finally:
+            if output is not None:
+                output.close()
     else:
-        KingAndAssassinsClient(args.name, (args.host, args.port), verbose=args.verbose)
+        recorder = None if args.metrics is None else metrics.Metrics('kingandassassins_client')
+        # Resolved only now, there is no network access at import time
+        host = socket.gethostbyname(socket.gethostname()) if args.host is None else args.host
+        BOTS[args.bot](args.name, (host, args.port), verbose=args.verbose, delta=args.delta,
+                       codec=args.codec, metrics=recorder, series=args.series,
+                       **_botoptions(args.bot, args.think_ms, args.workers, args.table_mb))
+        if recorder is not None:
+            recorder.export(args.metrics)
         
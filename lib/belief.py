@@ -0,0 +1,119 @@
+# belief.py
+# Belief over the hidden subsets of a fixed size of a set of items
+
+from itertools import combinations
+
+
+class SubsetBelief:
+    '''Class representing a belief over the subsets of 'k' items among 'n'.
+
+    Each subset is a hypothesis, numbered in the order of
+    itertools.combinations(range(n), k). The hypotheses still consistent
+    with the observations are the bits of the integer 'alive', and hard
+    observations (an item is or is not in the subset) are bitwise ands with
+    precomputed masks. Soft observations scale the weight of an item, the
+    weight of a hypothesis being the product of the ones of its items.
+    '''
+    def __init__(self, n, k):
+        self.n = n
+        self.k = k
+        self.hypotheses = tuple(combinations(range(n), k))
+        # containing[i] is the set of the hypotheses in which item i is
+        self.containing = [0] * n
+        for h, hypothesis in enumerate(self.hypotheses):
+            for i in hypothesis:
+                self.containing[i] |= 1 << h
+        self.all = (1 << len(self.hypotheses)) - 1
+        self.alive = self.all
+        self.weights = [1.0] * n
+        # Computed from the consistent hypotheses and their weights, until
+        # the next observation
+        self.__marginals = None
+        self.__distribution = None
+
+    def include(self, i):
+        '''Observe that item i is in the subset.'''
+        self.alive &= self.containing[i]
+        self._changed()
+
+    def exclude(self, i):
+        '''Observe that item i is not in the subset.'''
+        self.alive &= self.all ^ self.containing[i]
+        self._changed()
+
+    def scale(self, i, factor):
+        '''Observe evidence making item i 'factor' times more likely to be in the subset.'''
+        self.weights[i] *= factor
+        self._changed()
+
+    def _changed(self):
+        self.__marginals = None
+        self.__distribution = None
+
+    def count(self):
+        '''Get the number of hypotheses consistent with the observations.'''
+        return bin(self.alive).count('1')
+
+    def probability(self, i):
+        '''Get the probability that item i is in the subset.
+
+        Pre: At least one hypothesis is consistent with the observations.
+        Post: The returned value is the weighted share of the consistent
+              hypotheses that contain item i.
+        '''
+        if self.__marginals is None:
+            self.__marginals = self._marginals()
+        return self.__marginals[i]
+
+    def _marginals(self):
+        # One pass over the consistent hypotheses
+        weights, hypotheses = self.weights, self.hypotheses
+        marginals = [0.0] * self.n
+        total = 0.0
+        alive = self.alive
+        while alive:
+            low = alive & -alive
+            hypothesis = hypotheses[low.bit_length() - 1]
+            weight = 1.0
+            for i in hypothesis:
+                weight *= weights[i]
+            for i in hypothesis:
+                marginals[i] += weight
+            total += weight
+            alive ^= low
+        if total > 0:
+            marginals = [marginal / total for marginal in marginals]
+        return marginals
+
+    def sample(self, rnd):
+        '''Draw a hypothesis according to the belief.
+
+        Pre: At least one hypothesis is consistent with the observations,
+             'rnd' is a random.Random instance.
+        Post: The returned value is a tuple of 'k' items, drawn among the
+              consistent hypotheses with a probability proportional to their
+              weight.
+        '''
+        if self.__distribution is None:
+            self.__distribution = self._distribution()
+        candidates, cumulated = self.__distribution
+        return rnd.choices(candidates, cum_weights=cumulated)[0]
+
+    def _distribution(self):
+        # Consistent hypotheses and their cumulated weights, so that drawing
+        # many of them only costs a binary search each
+        weights, hypotheses = self.weights, self.hypotheses
+        candidates, cumulated = [], []
+        total = 0.0
+        alive = self.alive
+        while alive:
+            low = alive & -alive
+            hypothesis = hypotheses[low.bit_length() - 1]
+            weight = 1.0
+            for i in hypothesis:
+                weight *= weights[i]
+            total += weight
+            candidates.append(hypothesis)
+            cumulated.append(total)
+            alive ^= low
+        return candidates, cumulated
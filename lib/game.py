@@ -3,14 +3,24 @@
 # Version: April 20, 2016
 
 from abc import *
+import asyncio
 import copy
 import json
+import selectors
 import socket
+import struct
 import sys
+import time
+
+from lib import metrics as gamemetrics
 
 DEFAULT_BUFFER_SIZE = 1024
+MAX_MESSAGE_SIZE = 1 << 24
 SECTION_WIDTH = 60
 
+# Every message on the wire is prefixed by its length (4 bytes, big-endian)
+HEADER = struct.Struct('!I')
+
 
 def _printsection(title):
     print()
@@ -23,8 +33,137 @@ class InvalidMoveException(Exception):
         super().__init__(message)
 
 
+def frame(data):
+    '''Build the length-prefixed frame of a message.
+
+    Pre: 'data' is a bytes-like object
+    Post: The returned value contains the header followed by 'data'.
+    '''
+    return HEADER.pack(len(data)) + data
+
+
+class Connection:
+    '''Class representing a framed connection over a connected socket.
+
+    Incoming data is received into a reusable buffer, from which complete
+    messages are cut (several messages can arrive with one recv and one
+    message can need several of them). Outgoing messages are buffered by
+    send and only written on the socket, all at once, by flush. The socket
+    is non-blocking, a selector waits for it to be ready, so that a message
+    can be waited for with a timeout.
+    '''
+    def __init__(self, sock, buffersize=DEFAULT_BUFFER_SIZE):
+        sock.setblocking(False)
+        self.__socket = sock
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(sock, selectors.EVENT_READ)
+        self.__buffer = bytearray(buffersize)
+        self.__view = memoryview(self.__buffer)
+        # Unread data lies in self.__buffer[self.__start:self.__end]
+        self.__start = 0
+        self.__end = 0
+        self.__out = bytearray()
+
+    @property
+    def socket(self):
+        return self.__socket
+
+    def getpeername(self):
+        return self.__socket.getpeername()
+
+    def send(self, data):
+        '''Queue a message to be sent by the next flush.'''
+        self.__out += HEADER.pack(len(data))
+        self.__out += data
+
+    def flush(self):
+        '''Write all the queued messages on the socket.'''
+        if not self.__out:
+            return
+        with memoryview(self.__out) as view:
+            sent = 0
+            while sent < len(view):
+                try:
+                    sent += self.__socket.send(view[sent:])
+                except BlockingIOError:
+                    # The peer does not read as fast, wait for room
+                    self.__selector.modify(self.__socket, selectors.EVENT_WRITE)
+                    self.__selector.select()
+                    self.__selector.modify(self.__socket, selectors.EVENT_READ)
+        self.__out.clear()
+
+    def _message(self):
+        # Cut a complete message from the buffer, or return None
+        available = self.__end - self.__start
+        if available >= HEADER.size:
+            size = HEADER.unpack_from(self.__buffer, self.__start)[0]
+            if size > MAX_MESSAGE_SIZE:
+                raise ConnectionError('message too large ({} bytes)'.format(size))
+            if available >= HEADER.size + size:
+                start = self.__start + HEADER.size
+                self.__start = start + size
+                return bytes(self.__view[start:self.__start])
+            needed = HEADER.size + size
+        else:
+            needed = HEADER.size
+        # Make room for the whole message at the end of the buffer
+        if self.__start + needed > len(self.__buffer):
+            self.__view.release()
+            self.__buffer[:available] = self.__buffer[self.__start:self.__end]
+            if needed > len(self.__buffer):
+                self.__buffer.extend(bytes(needed - len(self.__buffer)))
+            self.__view = memoryview(self.__buffer)
+            self.__start, self.__end = 0, available
+        return None
+
+    def recv(self, timeout=None):
+        '''Receive the next message.
+
+        Pre: -
+        Post: The returned value contains the next message (as bytes).
+        Raises ConnectionError: If the connection has been closed by the peer.
+        Raises TimeoutError: If 'timeout' is not None and the whole message
+                             has not been received within 'timeout' seconds
+                             (the part received so far is kept).
+        '''
+        message = self._message()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while message is None:
+            remaining = None if deadline is None else max(0, deadline - time.perf_counter())
+            if not self.__selector.select(remaining):
+                raise TimeoutError('no message within {} s'.format(timeout))
+            try:
+                received = self.__socket.recv_into(self.__view[self.__end:])
+            except BlockingIOError:
+                continue
+            if received == 0:
+                raise ConnectionError('connection closed by peer')
+            self.__end += received
+            message = self._message()
+        return message
+
+    def close(self):
+        self.__view.release()
+        self.__selector.close()
+        self.__socket.close()
+
+
+async def readmessage(reader):
+    '''Read the next framed message from an asyncio stream reader.'''
+    try:
+        size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+        if size > MAX_MESSAGE_SIZE:
+            raise ConnectionError('message too large ({} bytes)'.format(size))
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('connection closed by peer')
+
+
 class GameState(metaclass=ABCMeta):
     '''Abstract class representing a generic game state.'''
+
+    __slots__ = ('_state',)
+
     def __init__(self, visible, hidden=None):
         self._state = {'visible': visible, 'hidden': hidden}
 
@@ -34,6 +173,14 @@ class GameState(metaclass=ABCMeta):
     def __repr__(self):
         return json.dumps(self._state, separators=(',', ':'))
 
+    def copy(self):
+        '''Get a copy of this state, sharing nothing mutable with it.
+
+        Games with a compact representation should override this method,
+        the default one does a deep copy.
+        '''
+        return copy.deepcopy(self)
+
     @abstractmethod
     def winner(self):
         '''Check whether the state is a winning state.
@@ -58,21 +205,96 @@ class GameState(metaclass=ABCMeta):
     def parse(cls, state):
         return cls(json.loads(state))
 
+    def pack(self):
+        '''Get a compact binary encoding of the visible state.
+
+        Pre: -
+        Post: The returned value contains the bytes encoding the visible
+              state, to be decoded with unpack, or None if this game does not
+              support a binary codec (the JSON one is then used).
+        '''
+        return None
+
+    @classmethod
+    def unpack(cls, data):
+        '''Build a state from its binary encoding, as returned by pack.'''
+        raise NotImplementedError
+
+    def delta(self):
+        '''Get the changes brought to the visible state by the last move.
+
+        Pre: -
+        Post: The returned value contains a string describing, for the next
+              player, the changes since its previous turn (the opponent's move
+              and anything it could not derive from it), or None if this
+              game does not support delta updates.
+        '''
+        return None
+
+    def applydelta(self, delta, player, move):
+        '''Bring this state up to date with a delta received from the server.
+
+        Pre: 'delta' has been built by delta() on the server, 'move' is the
+             last move played by 'player' (the local player) on this state.
+        Post: This state is the visible state the server had when it built
+              'delta'.
+        '''
+        raise NotImplementedError
+
     @classmethod
     def buffersize(cls):
         return DEFAULT_BUFFER_SIZE
 
 
 class GameServer(metaclass=ABCMeta):
-    '''Abstract class representing a generic game server.'''
-    def __init__(self, name, nbplayers, initialstate, verbose=False):
+    '''Abstract class representing a generic game server.
+
+    If 'metrics' is not None, it is a metrics.Metrics instance in which the
+    game loop records the duration of the phases of each turn (building the
+    PLAY message, sending it, waiting for the move, applymove and winner)
+    and the size of the messages. applymove can split its own phase with
+    self.metrics.lap (the remaining part keeps the name 'applymove').
+
+    A player has at most 'movetime' seconds to send each move and
+    'gametime' seconds for all its moves (no limit if None), the time being
+    measured by the server from the sending of the state to the reception
+    of the move. When a move is late, the game's defaultmove() is played
+    instead and the late move will be ignored; when the game's budget of a
+    player is spent (or there is no default move), it loses by forfeit.
+
+    With 'games' > 1, the server plays a series of games over the same
+    connections with the players that asked for it (the READY option
+    {'series': True}): each new game is announced by 'NEWGAME <number>',
+    the players move one seat down, the state is built by reset(), and the
+    series ends with 'BYE'. A single game is played if a player did not ask
+    for the series mode.
+    '''
+    def __init__(self, name, nbplayers, initialstate, verbose=False, metrics=None, movetime=None, gametime=None,
+                 games=1):
         self.__name = name
         self.__nbplayers = nbplayers
         self.__verbose = verbose
+        self.__metrics = gamemetrics.DISABLED if metrics is None else metrics
+        self.__movetime = movetime
+        self.__gametime = gametime
+        self.__games = games
         self._state = initialstate
         # Stats about the running game
         self.__currentplayer = None
         self.__turns = 0
+        # Thinking time used by each player, and number of its late moves
+        # still to be received (and ignored)
+        self.__clocks = [0.0] * nbplayers
+        self.__late = [0] * nbplayers
+        # Clock of the current player when its turn started
+        self.__turnclock = 0.0
+        # Winner of each game of the series, as the number of the connection
+        # of the player (in the order they connected), None for a draw
+        self.__results = []
+        # Protocol options asked by each player, and whether it already got
+        # the full state it can apply deltas to
+        self.__options = [{} for i in range(nbplayers)]
+        self.__synced = [False] * nbplayers
 
     @property
     def name(self):
@@ -90,6 +312,19 @@ class GameServer(metaclass=ABCMeta):
     def turns(self):
         return self.__turns
 
+    @property
+    def metrics(self):
+        return self.__metrics
+
+    @property
+    def clocks(self):
+        '''Thinking time used so far by each player, in seconds.'''
+        return list(self.__clocks)
+
+    @property
+    def results(self):
+        return list(self.__results)
+
     @abstractmethod
     def applymove(self, move):
         '''Apply a move.
@@ -100,9 +335,118 @@ class GameServer(metaclass=ABCMeta):
         '''
         ...
 
+    def reset(self, game):
+        '''Prepare the next game of a series.
+
+        Pre: 'game' >= 1 is the number of the next game (the first one being
+             0, played on the initial state).
+        Post: self._state is the initial state of a new game.
+        '''
+        raise NotImplementedError
+
+    def moveplayed(self, move, seconds):
+        '''Observe a valid move, which has just been applied.
+
+        Pre: 'move' has been played by the current player, who took
+             'seconds' seconds of thinking time for its turn (its invalid
+             moves included).
+        Post: This default implementation does nothing.
+        '''
+        pass
+
+    def gameended(self, winner):
+        '''Observe the end of a game (of each game of a series).
+
+        Pre: 'winner' is the number of the winner, None for a draw.
+        Post: This default implementation does nothing.
+        '''
+        pass
+
+    def _nextturn(self, move):
+        # The move of the current player was valid
+        self.moveplayed(move, self.__clocks[self.__currentplayer] - self.__turnclock)
+        self.__turns += 1
+        self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+        self.__turnclock = self.__clocks[self.__currentplayer]
+
+    def defaultmove(self):
+        '''Get the move played for the current player when its move is late.
+
+        Pre: -
+        Post: The returned value contains a valid move for the current
+              player, or None if there is none (the player then loses by
+              forfeit). This default implementation always returns None.
+        '''
+        return None
+
     @property
     def state(self):
-        return copy.deepcopy(self._state)
+        return self._state.copy()
+
+    def _budget(self, i):
+        # Time player i has for its next move, and whether it is limited by
+        # the game's budget rather than by the move's one
+        if self.__gametime is None:
+            return self.__movetime, False
+        remaining = max(0.0, self.__gametime - self.__clocks[i])
+        if self.__movetime is None or remaining <= self.__movetime:
+            return remaining, True
+        return self.__movetime, False
+
+    def _timedout(self, i, exhausted):
+        # Move played for player i, whose move is late, or None if it loses
+        # by forfeit; its late move is to be ignored
+        self.__late[i] += 1
+        move = None if exhausted else self.defaultmove()
+        if self.__verbose:
+            print('   Player {} ran out of time ({}).'.format(i, 'forfeit' if move is None else 'default move'))
+        return move
+
+    def _forfeit(self, i):
+        # Winner of the game if player i loses by forfeit
+        return (i + 1) % self.nbplayers if self.nbplayers == 2 else None
+
+    def _receive(self, i, player, timeout):
+        # Next move of player i, skipping its late ones
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        try:
+            while True:
+                move = player.recv(None if deadline is None else max(0, deadline - time.perf_counter()))
+                if self.__late[i] == 0:
+                    return move
+                self.__late[i] -= 1
+        finally:
+            self.__clocks[i] += time.perf_counter() - start
+
+    def _ready(self, i, data):
+        # Parse a 'READY [name [options]]' message from player i
+        data = data.split(' ', 2)
+        if data[0] != 'READY':
+            return None
+        try:
+            self.__options[i] = json.loads(data[2]) if len(data) == 3 else {}
+        except ValueError:
+            self.__options[i] = {}
+        return data[1] if len(data) >= 2 else 'Anonymous'
+
+    def _playmessage(self, i):
+        # Players in delta mode only get the full state once, and again after
+        # an invalid move (which may have partially modified the state)
+        if self.__options[i].get('delta') and self.__synced[i]:
+            delta = self._state.delta()
+            if delta is not None:
+                return 'DELTA {}'.format(delta).encode()
+        self.__synced[i] = True
+        if self.__options[i].get('codec') == 'binary':
+            packed = self._state.pack()
+            if packed is not None:
+                return b'PACKED ' + packed
+        # Serialised directly from the live state, it is not modified meanwhile
+        return 'PLAY {}'.format(self._state).encode()
+
+    def _desync(self):
+        self.__synced = [False] * self.nbplayers
 
     def _waitplayers(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -117,7 +461,7 @@ class GameServer(metaclass=ABCMeta):
         # Wait for enough players for a play
         try:
             while len(self.__players) < self.__nbplayers:
-                client = s.accept()[0]
+                client = Connection(s.accept()[0], self._state.__class__.buffersize())
                 self.__players.append(client)
                 if self.__verbose:
                     print(' - Client connected from {}:{} ({}/{}).'
@@ -134,15 +478,17 @@ class GameServer(metaclass=ABCMeta):
                 if self.__verbose:
                     print(' Initialising player {}...'.format(i))
                 player = self.__players[i]
-                player.sendall('START {}'.format(i).encode())
-                data = player.recv(self._state.__class__.buffersize()).decode().split(' ')
-                if data[0] != 'READY':
+                player.send('START {}'.format(i).encode())
+                player.flush()
+                # A player that is not ready in time is not ready at all
+                name = self._ready(i, player.recv(self.__movetime).decode())
+                if name is None:
                     if self.__verbose:
                         print(' - Player {} not ready to start.'.format(i))
                         _printsection('Current game ended')
                     return False
                 elif self.__verbose:
-                    print(' - Player {} ({}) ready to start.'.format(i, data[1] if len(data) == 2 else 'Anonymous'))
+                    print(' - Player {} ({}) ready to start.'.format(i, name))
         except OSError:
             if self.__verbose:
                 print('Error while notifying player {}.'.format(player))
@@ -153,7 +499,9 @@ class GameServer(metaclass=ABCMeta):
         return True
 
     def _gameloop(self):
+        metrics = self.__metrics
         self.__currentplayer = 0
+        self.__turnclock = self.__clocks[0]
         winner = -1
         if self.__verbose:
             print(' Initial state:')
@@ -163,50 +511,302 @@ class GameServer(metaclass=ABCMeta):
             player = self.__players[self.__currentplayer]
             if self.__verbose:
                 print("\n=> Turn #{} (player {})".format(self.turns, self.__currentplayer))
-            player.sendall('PLAY {}'.format(self.state).encode())
+            metrics.start()
+            message = self._playmessage(self.__currentplayer)
+            metrics.lap('message')
+            player.send(message)
+            player.flush()
+            metrics.lap('send')
+            metrics.size('sent', HEADER.size + len(message))
+            timeout, exhausted = self._budget(self.__currentplayer)
+            try:
+                move = self._receive(self.__currentplayer, player, timeout)
+                metrics.lap('wait')
+                metrics.size('received', HEADER.size + len(move))
+                move = move.decode()
+            except TimeoutError:
+                metrics.lap('wait')
+                move = self._timedout(self.__currentplayer, exhausted)
+                if move is None:
+                    winner = self._forfeit(self.__currentplayer)
+                    break
+                # Sent along with the next PLAY message
+                player.send('ERROR Out of time, a default move has been played'.encode())
+                self._desync()
             try:
-                move = player.recv(self._state.__class__.buffersize()).decode()
                 if self.__verbose:
                     print('   Move:', move)
+                    metrics.start()
                 self.applymove(move)
-                self.__turns += 1
-                self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+                metrics.lap('applymove')
+                self._nextturn(move)
             except InvalidMoveException as e:
+                metrics.lap('applymove')
                 if self.__verbose:
                     print('Invalid move:', e)
-                player.sendall('ERROR {}'.format(e).encode())
+                # Sent along with the next PLAY message
+                error = 'ERROR {}'.format(e).encode()
+                player.send(error)
+                metrics.size('sent', HEADER.size + len(error))
+                self._desync()
+                metrics.start()
+            winner = self._state.winner()
+            metrics.lap('winner')
             if self.__verbose:
                 print('   State:')
                 self._state.prettyprint()
-            winner = self._state.winner()
+        self.gameended(winner)
         if self.__verbose:
             _printsection('Game finished')
+            for i in range(self.nbplayers):
+                print(' Thinking time of player {}: {:.3f} s.'.format(i, self.__clocks[i]))
         # Notify players about won/lost status
         if winner is not None:
             for i in range(self.nbplayers):
-                self.__players[i].sendall(('WON' if winner == i else 'LOST').encode())
+                self.__players[i].send(('WON' if winner == i else 'LOST').encode())
             if self.__verbose:
                 print(' The winner is player {}.'.format(winner))
         # Notify players that the game ended
         else:
             for player in self.__players:
-                player.sendall('END'.encode())
-        # Close the connexions with the clients
+                player.send('END'.encode())
         for player in self.__players:
-            player.close()
-        if self.__verbose:
-            _printsection('Game ended')
+            player.flush()
+        return winner
+
+    def _series(self):
+        # Play the games of the series, the seat of connection j being
+        # (j - game) % nbplayers in each game
+        games = self.__games if all(options.get('series') for options in self.__options) else 1
+        if self.__verbose and games < self.__games:
+            print(' Not all the players asked for a series, only one game is played.')
+        for game in range(games):
+            if game > 0:
+                self.__players = self.__players[1:] + self.__players[:1]
+                self.__options = self.__options[1:] + self.__options[:1]
+                self.__late = self.__late[1:] + self.__late[:1]
+                self.__synced = [False] * self.nbplayers
+                self.__clocks = [0.0] * self.nbplayers
+                self.__turns = 0
+                self.reset(game)
+                if self.__verbose:
+                    _printsection('Game {} of the series'.format(game + 1))
+                for i in range(self.nbplayers):
+                    self.__players[i].send('NEWGAME {}'.format(i).encode())
+            winner = self._gameloop()
+            self.__results.append(None if winner is None else (winner + game) % self.nbplayers)
+        for i in range(self.nbplayers):
+            if self.__options[i].get('series'):
+                self.__players[i].send('BYE'.encode())
+                self.__players[i].flush()
 
     def run(self):
         if self._waitplayers():
-            self._gameloop()
+            try:
+                self._series()
+            finally:
+                # Close the connexions with the clients
+                for player in self.__players:
+                    player.close()
+            if self.__verbose:
+                _printsection('Game ended')
+
+    async def _asyncplay(self, players):
+        '''Play a whole game with already connected players, on an event loop.
+
+        Pre: 'players' is a list of self.nbplayers (reader, writer) pairs of
+             asyncio streams.
+        Post: The game has been played, unless a player was not ready or got
+              disconnected, and the returned value is the winner (-1 if the
+              game did not complete). The streams are not closed.
+        '''
+        # Notify players that the game started
+        for i in range(len(players)):
+            reader, writer = players[i]
+            writer.write(frame('START {}'.format(i).encode()))
+            await writer.drain()
+            if self._ready(i, (await readmessage(reader)).decode()) is None:
+                if self.__verbose:
+                    print(' - {}: player {} not ready to start.'.format(self.name, i))
+                return -1
+        self.__currentplayer = 0
+        self.__turnclock = self.__clocks[0]
+        winner = -1
+        # Reads of the players' moves, a read that timed out is kept going
+        reads = [None] * len(players)
+        # Loop until the game ends with a winner or with a draw
+        while winner == -1:
+            reader, writer = players[self.__currentplayer]
+            writer.write(frame(self._playmessage(self.__currentplayer)))
+            await writer.drain()
+            timeout, exhausted = self._budget(self.__currentplayer)
+            try:
+                move = (await self._asyncreceive(self.__currentplayer, reader, reads, timeout)).decode()
+            except TimeoutError:
+                move = self._timedout(self.__currentplayer, exhausted)
+                if move is None:
+                    winner = self._forfeit(self.__currentplayer)
+                    break
+                # Sent along with the next PLAY message
+                writer.write(frame('ERROR Out of time, a default move has been played'.encode()))
+                self._desync()
+            try:
+                self.applymove(move)
+                self._nextturn(move)
+            except InvalidMoveException as e:
+                # Sent along with the next PLAY message
+                writer.write(frame('ERROR {}'.format(e).encode()))
+                self._desync()
+            winner = self._state.winner()
+        for read in reads:
+            if read is not None:
+                read.cancel()
+        self.gameended(winner)
+        # Notify players about won/lost status, or that the game ended
+        for i in range(len(players)):
+            writer = players[i][1]
+            if winner is None:
+                writer.write(frame('END'.encode()))
+            else:
+                writer.write(frame(('WON' if winner == i else 'LOST').encode()))
+            await writer.drain()
+        if self.__verbose:
+            print(' - {}: game finished after {} turns (winner: {}).'.format(self.name, self.turns, winner))
+        return winner
+
+    async def _asyncreceive(self, i, reader, reads, timeout):
+        # Next move of player i, skipping its late ones, like _receive
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        try:
+            while True:
+                if reads[i] is None:
+                    reads[i] = asyncio.ensure_future(readmessage(reader))
+                remaining = None if deadline is None else max(0, deadline - time.perf_counter())
+                done, pending = await asyncio.wait((reads[i],), timeout=remaining)
+                if len(done) == 0:
+                    raise TimeoutError('no message within {} s'.format(timeout))
+                move, reads[i] = reads[i].result(), None
+                if self.__late[i] == 0:
+                    return move
+                self.__late[i] -= 1
+        finally:
+            self.__clocks[i] += time.perf_counter() - start
+
+
+class MatchServer:
+    '''Asyncio server hosting many concurrent games on a single port.
+
+    Clients are accepted continuously and grouped by 'nbplayers', in their
+    order of arrival, into matches; the ones that disconnected while waiting
+    are dropped. Each match is played by a fresh game server built by
+    'factory' and only lives as a task on the event loop (no thread, no
+    socket of its own).
+    '''
+    def __init__(self, factory, nbplayers, host, port, verbose=False):
+        self.__factory = factory
+        self.__nbplayers = nbplayers
+        self.__host = host
+        self.__port = port
+        self.__verbose = verbose
+        self.__waiting = []
+        self.__matches = set()
+        self.__played = 0
+
+    @property
+    def running(self):
+        return len(self.__matches)
+
+    @property
+    def played(self):
+        return self.__played
+
+    async def _handle(self, reader, writer):
+        # Each connection waits in its handler until its match is over
+        done = asyncio.get_running_loop().create_future()
+        self.__waiting.append((reader, writer, done))
+        if self.__verbose:
+            print(' - Client connected from {}:{} ({} waiting).'
+                  .format(*writer.get_extra_info('peername')[:2], len(self.__waiting))
+                  )
+        self._dropclosed()
+        nbplayers = self.__nbplayers
+        while len(self.__waiting) >= nbplayers:
+            players, self.__waiting = self.__waiting[:nbplayers], self.__waiting[nbplayers:]
+            task = asyncio.ensure_future(self._match(self.__factory(), players))
+            self.__matches.add(task)
+            task.add_done_callback(self.__matches.discard)
+        await done
+
+    def _dropclosed(self):
+        # Release the waiting clients whose connection was closed (the end
+        # of their stream has been received)
+        waiting = []
+        for reader, writer, done in self.__waiting:
+            if reader.at_eof():
+                writer.close()
+                done.set_result(None)
+                if self.__verbose:
+                    print(' - Waiting client disconnected.')
+            else:
+                waiting.append((reader, writer, done))
+        self.__waiting = waiting
+
+    async def _match(self, game, players):
+        try:
+            await game._asyncplay([(reader, writer) for reader, writer, done in players])
+            self.__played += 1
+        except OSError as e:
+            if self.__verbose:
+                print(' - {}: match aborted ({}).'.format(game.name, e))
+        finally:
+            for reader, writer, done in players:
+                writer.close()
+                if not done.done():
+                    done.set_result(None)
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.__host, self.__port)
+        if self.__verbose:
+            _printsection('Starting match server')
+            print(' Match server listening on {}:{}.'.format(self.__host, self.__port))
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        if self.__verbose:
+            _printsection('Match server ended ({} games played)'.format(self.played))
 
 
 class GameClient(metaclass=ABCMeta):
-    '''Abstract class representing a game client'''
-    def __init__(self, server, stateclass, verbose=False):
+    '''Abstract class representing a game client
+
+    If 'server' is None, the client is not connected to any server and can be
+    driven in-process by calling its _nextmove method directly. The 'options'
+    are sent to the server with the READY message, {'delta': True} asks for
+    delta updates instead of the full state at every turn and
+    {'codec': 'binary'} for full states encoded by GameState.pack instead of
+    JSON and {'series': True} to stay connected for the next games, if the
+    server plays a series (see GameServer). If 'metrics' is not None, it is a
+    metrics.Metrics instance in which the game loop records the duration of
+    the phases of each turn (waiting for the state, decoding it, _nextmove and
+    sending the move) and the size of the messages.
+    '''
+    def __init__(self, server, stateclass, verbose=False, name=None, options=None, metrics=None):
         self.__stateclass = stateclass
         self.__verbose = verbose
+        self.__metrics = gamemetrics.DISABLED if metrics is None else metrics
+        self.__name = 'Anonymous' if name is None else name
+        self.__options = {} if options is None else options
+        # Last full state received, kept up to date by the deltas
+        self.__state = None
+        self.__lastmove = None
+        if server is None:
+            return
         if self.__verbose:
             _printsection('Starting game')
         addrinfos = socket.getaddrinfo(*server, socket.AF_INET, socket.SOCK_STREAM)
@@ -215,35 +815,79 @@ class GameClient(metaclass=ABCMeta):
             s.connect(addrinfos[0][4])
             if self.__verbose:
                 print(' Connected to the game server on {}:{}.'.format(*addrinfos[0][4]))
-            self.__server = s
-            self._gameloop()
         except OSError:
             print(' Impossible to connect to the game server on {}:{}.'.format(*addrinfos[0][4]))
+            return
+        self.__server = Connection(s, self.__stateclass.buffersize())
+        try:
+            self._gameloop()
+        except ConnectionError as e:
+            if self.__verbose:
+                print(' Connection with the game server lost ({}).'.format(e))
+            self.__server.close()
 
     def _gameloop(self):
         server = self.__server
+        metrics = self.__metrics
         running = True
         while running:
-            data = server.recv(self.__stateclass.buffersize()).decode()
-            command = data[:data.index(' ')] if ' ' in data else data
+            raw = server.recv()
+            metrics.size('received', HEADER.size + len(raw))
+            separator = raw.find(b' ')
+            command = (raw if separator == -1 else raw[:separator]).decode()
+            # The payload of a PACKED message is binary
+            data = raw.decode() if command != 'PACKED' else None
             if command == 'START':
                 self._playernb = int(data[data.index(' '):])
-                server.sendall('READY'.encode())
+                ready = 'READY {}'.format(self.__name)
+                if self.__options:
+                    ready += ' ' + json.dumps(self.__options, separators=(',', ':'))
+                server.send(ready.encode())
+                server.flush()
+                metrics.start()
                 if self.__verbose:
                     _printsection('Game started')
                     print("   Player's number: {}".format(self._playernb))
-            elif command == 'PLAY':
-                state = self.__stateclass.parse(data[data.index(' ')+1:])
+            elif command == 'NEWGAME':
+                # Next game of a series, the connection and the options are kept
+                self._playernb = int(data[data.index(' '):])
+                self.__state = None
+                self.__lastmove = None
+                self._newgame()
+                metrics.start()
+                if self.__verbose:
+                    _printsection('New game started')
+                    print("   Player's number: {}".format(self._playernb))
+            elif command in ('PLAY', 'PACKED', 'DELTA'):
+                # Time spent by the server and the opponent, and on the network
+                metrics.lap('wait')
+                if command == 'PLAY':
+                    state = self.__stateclass.parse(data[data.index(' ')+1:])
+                elif command == 'PACKED':
+                    state = self.__stateclass.unpack(raw[separator+1:])
+                else:
+                    state = self.__state
+                    state.applydelta(data[data.index(' ')+1:], self._playernb, self.__lastmove)
+                self.__state = state
+                metrics.lap('decode')
                 if self.__verbose:
                     print("\n=> Player's turn to play")
                     print('   State:')
                     state.prettyprint()
+                    metrics.start()
                 move = self._nextmove(state)
+                metrics.lap('nextmove')
+                self.__lastmove = move
                 if self.__verbose:
                     print('   Move:', move)
-                server.sendall(move.encode())
+                move = move.encode()
+                server.send(move)
+                server.flush()
+                metrics.lap('send')
+                metrics.size('sent', HEADER.size + len(move))
             elif command in ('WON', 'LOST', 'END'):
-                running = False
+                # In series mode, the server tells when the series is over
+                running = bool(self.__options.get('series'))
                 if self.__verbose:
                     _printsection('Game finished')
                     if command == 'WON':
@@ -253,12 +897,28 @@ class GameClient(metaclass=ABCMeta):
                     else:
                         print(' It is draw.')
                     _printsection('Game ended')
+                if not running:
+                    server.close()
+            elif command == 'BYE':
+                running = False
+                if self.__verbose:
+                    _printsection('Series ended')
                 server.close()
             else:
                 if self.__verbose:
                     print('Specific data received:', data)
                 self._handle(data)
 
+    def _newgame(self):
+        '''Prepare the player for the next game of a series.
+
+        Pre: -
+        Post: What the player knows of the previous game has been forgotten,
+              its caches may be kept. This default implementation does
+              nothing.
+        '''
+        pass
+
     @abstractmethod
     def _handle(self, command):
         '''Handle a command.
@@ -0,0 +1,156 @@
+# gamelog.py
+# Append-only log of game records, with an index and a memory-mapped reader
+
+import mmap
+import os
+import struct
+
+# The log file starts with MAGIC, then holds the records, each one prefixed
+# by its length; the index file holds the offset of each record in the log
+MAGIC = b'GAMELOG1'
+LENGTH = struct.Struct('!I')
+OFFSET = struct.Struct('!Q')
+
+
+def indexpath(path):
+    return path + '.idx'
+
+
+class GameLogWriter:
+    '''Class representing a log of game records opened for appending.
+
+    A record is any bytes-like object (its encoding is up to the game). It is
+    written to the log, then its offset to the index, so that the index
+    only lists complete records, even if the writer is interrupted; the
+    index can be rebuilt from the log by reindex().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.__log = open(path, 'ab')
+        if self.__log.tell() == 0:
+            self.__log.write(MAGIC)
+            self.__log.flush()
+        self.__index = open(indexpath(path), 'ab')
+
+    def append(self, record):
+        '''Append a record to the log.
+
+        Pre: 'record' is a bytes-like object.
+        Post: The record has been written to the log and to the index, and
+              its number in the log is returned.
+        '''
+        offset = self.__log.tell()
+        self.__log.write(LENGTH.pack(len(record)))
+        self.__log.write(record)
+        self.__log.flush()
+        self.__index.write(OFFSET.pack(offset))
+        self.__index.flush()
+        return self.__index.tell() // OFFSET.size - 1
+
+    def close(self):
+        self.__log.close()
+        self.__index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GameLogReader:
+    '''Class representing a log of game records opened for reading.
+
+    The log and its index are memory-mapped: the number of records is known
+    from the size of the index and any record is reached through its offset,
+    without reading the ones before it. The records are returned as bytes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.__log = open(path, 'rb')
+        self.__index = open(indexpath(path), 'rb')
+        self.__logmap = _map(self.__log)
+        self.__indexmap = _map(self.__index)
+        if self.__logmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{} is not a game log'.format(path))
+        self.__count = len(self.__indexmap) // OFFSET.size
+        # Ignore an index entry whose record was not completely written
+        while self.__count > 0 and self._end(self.__count - 1) > len(self.__logmap):
+            self.__count -= 1
+
+    def _end(self, i):
+        offset = OFFSET.unpack_from(self.__indexmap, i * OFFSET.size)[0]
+        if offset + LENGTH.size > len(self.__logmap):
+            return offset + LENGTH.size
+        return offset + LENGTH.size + LENGTH.unpack_from(self.__logmap, offset)[0]
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, i):
+        '''Get record number i (negative numbers count from the end).'''
+        if i < 0:
+            i += self.__count
+        if not 0 <= i < self.__count:
+            raise IndexError('no record {} in {}'.format(i, self.path))
+        offset = OFFSET.unpack_from(self.__indexmap, i * OFFSET.size)[0]
+        size = LENGTH.unpack_from(self.__logmap, offset)[0]
+        return self.__logmap[offset + LENGTH.size:offset + LENGTH.size + size]
+
+    def __iter__(self):
+        for i in range(self.__count):
+            yield self[i]
+
+    def close(self):
+        self.__logmap.close()
+        self.__indexmap.close()
+        self.__log.close()
+        self.__index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _map(file):
+    # Read-only map of a whole file (an empty file cannot be mapped)
+    if os.fstat(file.fileno()).st_size == 0:
+        return _EmptyMap()
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _EmptyMap(bytes):
+    # Stands for the map of an empty file
+    def close(self):
+        pass
+
+
+def reindex(path):
+    '''Rebuild the index of a log from the log itself.
+
+    Pre: 'path' is a log written by GameLogWriter.
+    Post: The index lists the complete records of the log, and the returned
+          value is their number. An incomplete last record is cut from the
+          log, so that new records can be appended after the others.
+    '''
+    offsets = []
+    with open(path, 'r+b') as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a game log'.format(path))
+        offset = len(MAGIC)
+        size = os.fstat(log.fileno()).st_size
+        while offset + LENGTH.size <= size:
+            log.seek(offset)
+            end = offset + LENGTH.size + LENGTH.unpack(log.read(LENGTH.size))[0]
+            if end > size:
+                break
+            offsets.append(offset)
+            offset = end
+        log.truncate(offset)
+    with open(indexpath(path), 'wb') as index:
+        for offset in offsets:
+            index.write(OFFSET.pack(offset))
+    return len(offsets)
@@ -0,0 +1,300 @@
+# mcts.py
+# Monte Carlo Tree Search for two-player games played action by action
+
+import math
+import random
+import time
+
+from lib import game
+from lib import transposition
+
+# Estimated memory used by a node owned by a transposition table, in bytes:
+# the table's entry, the node and its children's dictionary. Measured on
+# searches of the King & Assassins game with a full table, which keeps the
+# most recently used nodes, near the root and with the most children
+TABLE_ENTRY_SIZE = transposition.ENTRY_SIZE + 1120
+
+
+class Node:
+    '''Class representing a node of a search tree.
+
+    A node is reached by 'player' playing an action from its parent (or from
+    its parents, when positions are shared through a transposition table),
+    and it holds the statistics of the iterations that went through it:
+    'wins' is counted for 'player', and 'avails' is the number of times it
+    was reachable when a parent was visited (an action may only be legal in
+    some of the determinizations of the hidden information).
+
+    'children' maps actions to the child nodes, or to their keys in the
+    transposition table of the search if it has one: the table then owns
+    the nodes, so that evicting one of them frees it (and its subtree, but
+    the nodes shared with other paths), and the action leading to it is
+    untried again.
+    '''
+
+    __slots__ = ('player', 'key', 'children', 'visits', 'wins', 'avails')
+
+    def __init__(self, player=None, key=None):
+        self.player = player
+        self.key = key
+        self.children = {}
+        self.visits = 0
+        self.wins = 0.0
+        self.avails = 1
+
+
+class MCTS:
+    '''Class representing a Monte Carlo Tree Search (information set MCTS).
+
+    The searched states must provide legal_actions(player), apply(action,
+    player), copy() and winner() (-1 while the game is not over). A turn is
+    a sequence of actions ended by the action 'end', which is always legal
+    and after which the other player plays. Each iteration is played on its
+    own copy of the searched state, given by 'determinize' if the state has
+    hidden information; the tree is over the actions, and a random playout
+    of at most 'horizon' turns follows its leaves. An unfinished playout is
+    scored by 'evaluate', that gives the chance of player 0 to win a state.
+
+    A 'policy' can guide the search with knowledge of the game: given a
+    state, a player and a list of its actions ('end' included), it returns
+    their weights (positive numbers). The playouts then draw their actions
+    with these weights, instead of uniformly, and the expansion tries the
+    heaviest untried action first. With a 'widening', a node visited n
+    times has at most widening * sqrt(n) children (and at least one), so
+    that the search goes deeper along the heaviest actions before trying
+    the other ones.
+
+    The tree is kept from one search to the next: advance() follows the
+    actions played meanwhile, and the subtree is reused if its root has the
+    same 'key' as the searched state.
+
+    With a transposition table (see lib/transposition.py), the states must
+    also provide zobrist(), a hash of the position, and the nodes of a same
+    position reached by different orders of actions are shared. The keys of
+    the table include the number of the turn, so that the tree stays
+    acyclic. The table bounds the memory used by the tree (the nodes it
+    evicts are freed, see Node), if its entries are sized by
+    TABLE_ENTRY_SIZE.
+    '''
+    def __init__(self, end, evaluate=None, horizon=2, exploration=0.7, key=None, rnd=None, table=None, policy=None,
+                 widening=None):
+        self.end = end
+        self.evaluate = evaluate
+        self.policy = policy
+        self.widening = widening
+        self.horizon = horizon
+        self.exploration = exploration
+        self.key = key
+        self.rnd = random.Random() if rnd is None else rnd
+        self.table = table
+        self.root = None
+        # Number of turns played before the root
+        self.turn = 0
+        self.iterations = 0
+
+    def advance(self, actions):
+        '''Move the root of the tree along played actions.
+
+        Pre: 'actions' is a sequence of actions, turns included.
+        Post: The root is the node reached by 'actions', or None if the tree
+              does not contain it.
+        '''
+        node = self.root
+        for action in actions:
+            if action == self.end:
+                self.turn += 1
+            if node is not None:
+                node = self._child(node, action)
+        self.root = node
+
+    def newgame(self):
+        '''Forget the tree of the previous game, but not the transposition table.'''
+        self.root = None
+        self.turn = 0
+
+    def search(self, state, player, thinkms=None, determinize=None, iterations=None):
+        '''Search the best turn to play.
+
+        Pre: It is the beginning of the turn of 'player' in 'state', and
+             'thinkms' or 'iterations' is not None.
+        Post: The returned value is the list of the actions (without 'end')
+              of the most visited turn, after iterating for 'thinkms'
+              milliseconds and at most 'iterations' times. The number of
+              iterations done is in self.iterations, and the statistics of
+              the searched turns are given by turnstats().
+        '''
+        key = None if self.key is None else self.key(state)
+        if self.root is None or self.root.key != key or self.root.player == player:
+            self.root = Node(1 - player, key)
+        deadline = None if thinkms is None else time.perf_counter() + thinkms / 1000
+        self.iterations = 0
+        while iterations is None or self.iterations < iterations:
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            self._iterate(state.copy() if determinize is None else determinize(state, self.rnd), player)
+            self.iterations += 1
+        return bestturn(state, player, self.turnstats(player), self.end)
+
+    def _iterate(self, state, player):
+        # One iteration: selection, expansion, playout and backpropagation
+        rnd = self.rnd
+        table = self.table
+        node = self.root
+        path = [node]
+        turn = self.turn
+        expanded = False
+        while not expanded and state.winner() == -1:
+            actions = state.legal_actions(player)
+            actions.append(self.end)
+            children = node.children
+            # The children in the tree, the evicted ones being untried
+            found = {}
+            untried = []
+            for action in actions:
+                child = children.get(action)
+                if child is not None and table is not None:
+                    child = table.get(child)
+                if child is None:
+                    untried.append(action)
+                else:
+                    child.avails += 1
+                    found[action] = child
+            if len(untried) > 0 and (self.widening is None or len(found) == 0
+                                     or len(found) < self.widening * math.sqrt(node.visits)):
+                if self.policy is None:
+                    action = rnd.choice(untried)
+                else:
+                    weights = self.policy(state, player, untried)
+                    action = untried[max(range(len(untried)), key=weights.__getitem__)]
+                state.apply(action, player)
+                node, children[action] = self._expand(state, player, turn + (action == self.end))
+                expanded = True
+            else:
+                action = self._select(found)
+                node = found[action]
+                state.apply(action, player)
+            path.append(node)
+            if action == self.end:
+                player = 1 - player
+                turn += 1
+        reward = self._playout(state, player)
+        for node in path:
+            node.visits += 1
+            node.wins += reward if node.player == 0 else 1 - reward
+        return reward
+
+    def _expand(self, state, player, turn):
+        # Node of the position reached by an action of 'player' during the
+        # turn 'turn', shared with the other paths to it through the table,
+        # and the value linking its parent to it (see Node)
+        key = None if self.key is None else self.key(state)
+        if self.table is None:
+            node = Node(player, key)
+            return node, node
+        tablekey = ((turn << 1 | player) << 64) | state.zobrist()
+        node = self.table.get(tablekey)
+        if node is None:
+            node = Node(player, key)
+            self.table.put(tablekey, node)
+        return node, tablekey
+
+    def _child(self, node, action):
+        # Child of a node reached by an action, None if it is not in the tree
+        child = node.children.get(action)
+        if child is None or self.table is None:
+            return child
+        return self.table.peek(child)
+
+    def _select(self, children):
+        # Action whose child has the best upper confidence bound
+        best, bestscore = None, -1
+        exploration = self.exploration
+        for action, child in children.items():
+            score = child.wins / child.visits + exploration * math.sqrt(math.log(child.avails) / child.visits)
+            if score > bestscore:
+                best, bestscore = action, score
+        return best
+
+    def _playout(self, state, player):
+        # Random playout, the returned value is the reward of player 0
+        rnd = self.rnd
+        turns = 0
+        winner = state.winner()
+        policy = self.policy
+        while winner == -1 and turns < self.horizon:
+            actions = state.legal_actions(player)
+            actions.append(self.end)
+            if policy is None:
+                action = actions[rnd.randrange(len(actions))]
+            else:
+                action = rnd.choices(actions, policy(state, player, actions))[0]
+            state.apply(action, player)
+            if action == self.end:
+                player = 1 - player
+                turns += 1
+            winner = state.winner()
+        if winner != -1:
+            return 1.0 if winner == 0 else 0.0
+        return 0.5 if self.evaluate is None else self.evaluate(state)
+
+    def turnstats(self, player):
+        '''Get the statistics of the turns of 'player' from the root.
+
+        Pre: The root is at the beginning of a turn of 'player'.
+        Post: The returned value maps the actions of 'player' explored from
+              the root to pairs (visits, statistics of the next actions of
+              the turn), and can be merged with the ones of other searches
+              (see merge).
+        '''
+        return self._turnstats(self.root, player)
+
+    def _turnstats(self, node, player):
+        stats = {}
+        for action in node.children:
+            child = self._child(node, action)
+            if child is not None and child.player == player:
+                stats[action] = (child.visits, {} if action == self.end else self._turnstats(child, player))
+        return stats
+
+
+def merge(stats):
+    '''Merge turn statistics of several searches (root parallelization).
+
+    Pre: 'stats' is a sequence of values returned by MCTS.turnstats for the
+         same state and player.
+    Post: The returned value holds the statistics of all of them, the visits
+          of a same turn being summed.
+    '''
+    merged = {}
+    for stat in stats:
+        for action, (visits, children) in stat.items():
+            if action in merged:
+                merged[action] = (merged[action][0] + visits, merge((merged[action][1], children)))
+            else:
+                merged[action] = (visits, children)
+    return merged
+
+
+def bestturn(state, player, stats, end):
+    '''Get the most visited turn from turn statistics.
+
+    Pre: 'stats' has been returned by MCTS.turnstats or merge for 'state'
+         and 'player'.
+    Post: The returned value is the list of the most visited actions (without
+          'end') of the turn, stopped before its first action that is not
+          valid in 'state'. 'state' is left unchanged.
+    '''
+    state = state.copy()
+    turn = []
+    while len(stats) > 0:
+        action = max(stats, key=lambda action: stats[action][0])
+        if action == end:
+            break
+        try:
+            state.apply(action, player)
+        except game.InvalidMoveException:
+            # The tree may have been grown with other action points
+            break
+        turn.append(action)
+        stats = stats[action][1]
+    return turn
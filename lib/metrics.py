@@ -0,0 +1,161 @@
+# metrics.py
+# Timing and size histograms of the turns of a game, and their export
+
+import bisect
+import json
+import math
+import time
+
+# Upper bounds of the buckets of the histograms: durations from 1 µs to 10 s
+# (in seconds) and sizes of messages from 16 B to 1 MiB (in bytes)
+TIME_BUCKETS = tuple(float('{}e{}'.format(m, e)) for e in range(-6, 1) for m in (1, 2.5, 5)) + (10.0,)
+SIZE_BUCKETS = tuple(1 << e for e in range(4, 21))
+
+
+class Histogram:
+    '''Class representing a histogram of observed values.
+
+    The values are counted in the buckets whose upper bounds are 'bounds'
+    (and a last one without bound), along with their sum, minimum and
+    maximum, as in a Prometheus histogram.
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''Estimate a quantile of the observed values.
+
+        Pre: 0 <= q <= 1, and at least one value has been observed.
+        Post: The returned value is the q-quantile, interpolated linearly in
+              its bucket and bounded by the minimum and maximum values.
+        '''
+        rank = q * self.count
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and cumulated + count >= rank:
+                low = self.bounds[i - 1] if i > 0 else self.min
+                high = self.bounds[i] if i < len(self.bounds) else self.max
+                value = low + (high - low) * (rank - cumulated) / count
+                return max(self.min, min(self.max, value))
+            cumulated += count
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count,
+            'min': self.min,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+
+class Metrics:
+    '''Class representing the metrics of the turns of a game.
+
+    The game loops time their phases with lap(phase), which records the time
+    elapsed since the previous lap (or since start()), and the size of each
+    message with size(direction, nbytes). The values are aggregated in
+    histograms, exported at the end of the game by export().
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self.messages = {}
+        self.__last = time.perf_counter()
+
+    def start(self):
+        '''Start timing the next phase now.'''
+        self.__last = time.perf_counter()
+
+    def lap(self, phase):
+        '''Record the duration of a phase, ending now.'''
+        now = time.perf_counter()
+        if phase not in self.phases:
+            self.phases[phase] = Histogram(TIME_BUCKETS)
+        self.phases[phase].observe(now - self.__last)
+        self.__last = now
+
+    def size(self, direction, nbytes):
+        '''Record the size of a message sent or received.'''
+        if direction not in self.messages:
+            self.messages[direction] = Histogram(SIZE_BUCKETS)
+        self.messages[direction].observe(nbytes)
+
+    def summary(self):
+        '''Get the summary of the histograms, as a JSON-serializable dictionary.'''
+        return {
+            'name': self.name,
+            'phases': {phase: histogram.summary() for phase, histogram in self.phases.items()},
+            'messages': {direction: histogram.summary() for direction, histogram in self.messages.items()}
+        }
+
+    def prometheus(self):
+        '''Get the histograms in the Prometheus text exposition format.'''
+        lines = []
+        families = (
+            ('phase_seconds', 'phase', self.phases, 'Duration of the phases of the turns.'),
+            ('message_bytes', 'direction', self.messages, 'Size of the messages, framing included.')
+        )
+        for suffix, label, histograms, description in families:
+            metric = '{}_{}'.format(self.name, suffix)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for key, histogram in sorted(histograms.items()):
+                cumulated = 0
+                for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                    cumulated += count
+                    lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, key, bound, cumulated))
+                lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label, key, histogram.sum))
+                lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, key, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        '''Write the metrics to a file.
+
+        Pre: -
+        Post: The file 'path' contains the metrics in the Prometheus text
+              format if its name ends with '.prom', as a JSON summary
+              otherwise.
+        '''
+        with open(path, 'w') as file:
+            if path.endswith('.prom'):
+                file.write(self.prometheus())
+            else:
+                json.dump(self.summary(), file, indent=2)
+                file.write('\n')
+
+
+class NoMetrics:
+    '''Class representing disabled metrics, whose recording does nothing.'''
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def size(self, direction, nbytes):
+        pass
+
+
+# Metrics of the games played without recording any
+DISABLED = NoMetrics()
@@ -0,0 +1,139 @@
+# topology.py
+# Precomputed topology of a board made of square cells
+
+from collections import deque
+from functools import lru_cache
+
+# Distance of the cells from which the castle cannot be reached
+UNREACHABLE = 1 << 30
+
+class Topology:
+    '''Class representing the static topology of a rectangular board.
+
+    The cells are numbered row by row (cell x*width+y for position (x, y))
+    and all the neighbourhood queries are lookups in tables computed once:
+    - steps[d][cell]: the next cell in direction d, or -1 if it is off board;
+    - neighbours[cell]: the (d, next cell) pairs that are on the board;
+    - ground[cell]: whether the cell is on the ground (and not a roof);
+    - entries: maps (door cell, d) to the castle cell entered by a step in
+      direction d from the door cell;
+    - castle: the set of castle cells.
+    '''
+    def __init__(self, board, directions, doors=(), groundtype='G'):
+        self.height = len(board)
+        self.width = len(board[0])
+        size = self.height * self.width
+        self.ground = tuple(board[x][y] == groundtype for x in range(self.height) for y in range(self.width))
+        self.steps = {}
+        for d, (dx, dy) in directions.items():
+            steps = []
+            for cell in range(size):
+                x, y = divmod(cell, self.width)
+                nx, ny = x + dx, y + dy
+                steps.append(nx * self.width + ny if 0 <= nx < self.height and 0 <= ny < self.width else -1)
+            self.steps[d] = tuple(steps)
+        self.neighbours = tuple(
+            tuple((d, self.steps[d][cell]) for d in directions if self.steps[d][cell] != -1)
+            for cell in range(size)
+        )
+        self.entries = {}
+        for x, y, d in doors:
+            door = self.cell(x, y)
+            self.entries[(door, d)] = self.steps[d][door]
+        self.castle = frozenset(self.entries.values())
+        self.doors = frozenset(door for door, d in self.entries)
+
+    def cell(self, x, y):
+        return x * self.width + y
+
+    def coord(self, cell):
+        return divmod(cell, self.width)
+
+
+class DistanceField:
+    '''Class representing the distances of the cells to the castle.
+
+    The distance of a cell is the number of steps a piece standing on it
+    needs to enter the castle, walking on the ground cells that are not
+    blocked and entering the castle through one of its doors (it is 0 in the
+    castle and UNREACHABLE if there is no way). The field is kept up to date
+    as cells are blocked and freed: freeing a cell can only decrease the
+    distances, which are propagated from it, and blocking a cell is followed
+    by a new breadth-first search, whose results are cached for the same
+    blocked cells.
+    '''
+    def __init__(self, topology, blocked=()):
+        self.topology = topology
+        self.blocked = bytearray(topology.height * topology.width)
+        for cell in blocked:
+            self.blocked[cell] = 1
+        self.distances = list(_castledistances(topology, bytes(self.blocked)))
+
+    def distance(self, cell):
+        return self.distances[cell]
+
+    def block(self, cell):
+        '''Block a cell, that no piece can walk through any more.'''
+        if self.blocked[cell]:
+            return
+        self.blocked[cell] = 1
+        # Nothing changes if the castle could not be reached through the cell
+        if self.distances[cell] != UNREACHABLE:
+            self.distances = list(_castledistances(self.topology, bytes(self.blocked)))
+
+    def free(self, cell):
+        '''Free a blocked cell.'''
+        if not self.blocked[cell]:
+            return
+        self.blocked[cell] = 0
+        topology = self.topology
+        if cell in topology.castle:
+            self.distances = list(_castledistances(topology, bytes(self.blocked)))
+        elif topology.ground[cell]:
+            distances = self.distances
+            distance = UNREACHABLE
+            for d, n in topology.neighbours[cell]:
+                if n in topology.castle:
+                    if (cell, d) in topology.entries and not self.blocked[n]:
+                        distance = 1
+                elif topology.ground[n] and not self.blocked[n]:
+                    distance = min(distance, distances[n] + 1)
+            if distance < distances[cell]:
+                distances[cell] = distance
+                _propagate(topology, distances, self.blocked, deque((cell,)))
+
+    def save(self):
+        '''Get a snapshot of this field, to give to restore.'''
+        return bytes(self.blocked), list(self.distances)
+
+    def restore(self, snapshot):
+        '''Restore this field as it was when 'snapshot' was taken.'''
+        self.blocked = bytearray(snapshot[0])
+        self.distances = list(snapshot[1])
+
+
+@lru_cache(maxsize=4096)
+def _castledistances(topology, blocked):
+    # Breadth-first search from the castle, through its doors
+    distances = [UNREACHABLE] * (topology.height * topology.width)
+    queue = deque()
+    for castle in topology.castle:
+        distances[castle] = 0
+    for (door, d), castle in topology.entries.items():
+        if not blocked[castle] and not blocked[door] and distances[door] > 1:
+            distances[door] = 1
+            queue.append(door)
+    _propagate(topology, distances, blocked, queue)
+    return tuple(distances)
+
+
+def _propagate(topology, distances, blocked, queue):
+    # Decrease the distances of the free ground cells from the queued ones
+    ground, neighbours = topology.ground, topology.neighbours
+    while len(queue) > 0:
+        cell = queue.popleft()
+        distance = distances[cell] + 1
+        for d, n in neighbours[cell]:
+            if ground[n] and not blocked[n] and distances[n] > distance:
+                distances[n] = distance
+                queue.append(n)
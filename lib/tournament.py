@@ -0,0 +1,104 @@
+# tournament.py
+# Statistics of the results of games between players
+
+import math
+
+# Quantile of the normal distribution for 95% confidence intervals
+Z95 = 1.959964
+
+
+def wilson(wins, games, z=Z95):
+    '''Get the Wilson score interval of a win rate.
+
+    Pre: 0 <= wins <= games
+    Post: The returned value is the pair (low, high) of the bounds of the
+          confidence interval of the win rate, (0.0, 1.0) if games == 0.
+    '''
+    if games == 0:
+        return 0.0, 1.0
+    rate = wins / games
+    denominator = 1 + z * z / games
+    centre = (rate + z * z / (2 * games)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / games + z * z / (4 * games * games)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def elo(score):
+    '''Get the Elo rating difference corresponding to a score.
+
+    Pre: 0 <= score <= 1
+    Post: The returned value is the difference of rating for which the
+          expected score of the stronger player is 'score', infinite if
+          the score is 0 or 1.
+    '''
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return -400 * math.log10(1 / score - 1)
+
+
+class Standings:
+    '''Class representing the results of games between pairs of players.
+
+    The results are kept by pair of players (in the order of their names),
+    along with the wins of each seat. The win rates come with their Wilson
+    score interval, and the Elo differences with the interval given by the
+    bounds of the score's one.
+    '''
+    def __init__(self):
+        self.games = 0
+        self.turns = 0
+        self.pairs = {}
+
+    def add(self, players, winner, turns):
+        '''Add the result of a game.
+
+        Pre: 'players' are the names of the players by seat, 'winner' is the
+             seat of the winner (-1 for a draw).
+        Post: The result has been added to the ones of the pair of players.
+        '''
+        pair = tuple(sorted(players))
+        if pair not in self.pairs:
+            self.pairs[pair] = {'games': 0, 'wins': [0, 0], 'seatwins': [0] * len(players), 'turns': 0}
+        result = self.pairs[pair]
+        result['games'] += 1
+        result['turns'] += turns
+        if winner != -1:
+            result['seatwins'][winner] += 1
+            # With the same player on both seats, the wins are the first's
+            # ones if it played in the first seat
+            if pair[0] == pair[1]:
+                result['wins'][winner] += 1
+            else:
+                result['wins'][pair.index(players[winner])] += 1
+        self.games += 1
+        self.turns += turns
+
+    def report(self):
+        '''Get the statistics of every pair of players.
+
+        Pre: -
+        Post: The returned value is a list with, for each pair of players,
+              a dictionary with its number of games, wins of each player and
+              of each seat, the win rate of its first player and its
+              confidence interval, the Elo difference between the players
+              and its confidence interval and the average number of turns.
+        '''
+        report = []
+        for pair, result in sorted(self.pairs.items()):
+            games, wins = result['games'], result['wins']
+            score = (wins[0] + (games - wins[0] - wins[1]) / 2) / games
+            low, high = wilson(wins[0], games)
+            report.append({
+                'players': list(pair),
+                'games': games,
+                'wins': list(wins),
+                'seatwins': list(result['seatwins']),
+                'winrate': wins[0] / games,
+                'interval': [low, high],
+                'elo': elo(score),
+                'elointerval': [elo(low), elo(high)],
+                'turns': result['turns'] / games
+            })
+        return report
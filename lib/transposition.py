@@ -0,0 +1,74 @@
+# transposition.py
+# Bounded transposition table for the game tree searches
+
+from collections import OrderedDict
+
+# Estimated memory used by one entry of a table, in bytes: its key (a large
+# integer), the ordered dictionary's slot and link, and its spare room
+ENTRY_SIZE = 160
+
+
+class TranspositionTable:
+    '''Class representing a bounded transposition table.
+
+    The table maps keys of positions (such as Zobrist hashes) to values, and
+    holds at most 'maxbytes' // 'entrysize' entries, 'entrysize' being the
+    memory used by an entry and the part of its value owned by the table.
+    When it is full, the least recently used entry is replaced by the new
+    one; getting an entry makes it the most recently used one.
+    '''
+    def __init__(self, maxbytes=64 << 20, entrysize=ENTRY_SIZE):
+        self.__capacity = max(1, maxbytes // entrysize)
+        # Entries in the order of their last use, the least recent first
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key, default=None):
+        '''Get the value of a position.
+
+        Pre: -
+        Post: The returned value is the one stored for 'key', which is now
+              the most recently used entry, or 'default' if there is none.
+        '''
+        entries = self.__entries
+        if key not in entries:
+            self.misses += 1
+            return default
+        entries.move_to_end(key)
+        self.hits += 1
+        return entries[key]
+
+    def peek(self, key, default=None):
+        '''Get the value of a position, without counting it nor using its entry.'''
+        return self.__entries.get(key, default)
+
+    def put(self, key, value):
+        '''Store the value of a position.
+
+        Pre: -
+        Post: 'value' is stored for 'key' as the most recently used entry,
+              and the least recently used entry has been replaced if the
+              table was full.
+        '''
+        entries = self.__entries
+        if key in entries:
+            entries.move_to_end(key)
+        elif len(entries) >= self.__capacity:
+            entries.popitem(last=False)
+            self.evictions += 1
+        entries[key] = value
+
+    def clear(self):
+        self.__entries.clear()